@@ -17,10 +17,25 @@
 
 # sys allows us to pass script arguments to the script
 import sys
-from PyQt5.QtWidgets import QApplication 
-from .mainwindow import MainWindow
+import multiprocessing
 
 def main():
+    # Worker processes of a frozen program start by running the program,
+    # and freeze_support makes them run the worker instead
+    multiprocessing.freeze_support()
+
+    # "computerrainbow render" and "computerrainbow sweep" render to files
+    # without opening a window, so Qt is only imported for the program itself
+    if sys.argv[1:2] == ['render']:
+        from .cli import main as render_main
+        sys.exit(render_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['sweep']:
+        from .cli import sweep_main
+        sys.exit(sweep_main(sys.argv[2:]))
+
+    from PyQt5.QtWidgets import QApplication 
+    from .mainwindow import MainWindow
+
     # Creates our application object
     app = QApplication(sys.argv)
 
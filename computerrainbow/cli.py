@@ -0,0 +1,162 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# The command line renderers, run as "computerrainbow render" and
+# "computerrainbow sweep". They only use the Qt free core, so they work on
+# machines without a display.
+import argparse
+import os
+import sys
+import time
+
+from .core import DEFAULT_SETTINGS
+from .export import export_image, render_canvas
+from .sweep import expand_grid, parse_values, run_sweep
+
+# Help for each setting, in the order they are shown
+SETTINGS_HELP = {
+    'size_x': 'width of the image in pixels',
+    'size_y': 'height of the image in pixels',
+    'lightness': 'lightness from -50 to 50',
+    'cent_lambda': 'center wavelength in nm, from 380 to 750',
+    'color_bits_start': 'color bits of the leftmost column',
+    'color_res_x': 'width in pixels of each column',
+    'color_res_y': 'height in pixels of each color',
+    'color_no_start': 'number of colors in the first column',
+    'color_step_factor': 'number of colors added for each column',
+}
+
+
+def settings_arguments(parser):
+    '''Adds an option for each setting, named like the setting with
+    dashes, to an argparse parser'''
+    for key, help_text in SETTINGS_HELP.items():
+        option = '--' + key.replace('_', '-')
+        if key == 'color_bits_start':
+            parser.add_argument(option, type=int, choices=(6, 12, 24),
+                                default=DEFAULT_SETTINGS[key], help=help_text)
+        else:
+            parser.add_argument(option, type=int, default=DEFAULT_SETTINGS[key],
+                                help=f'{help_text} (default {DEFAULT_SETTINGS[key]})')
+
+
+def sweep_arguments(parser):
+    '''Adds an option for each setting that takes a value, a list or a range'''
+    for key, help_text in SETTINGS_HELP.items():
+        parser.add_argument('--' + key.replace('_', '-'), default=str(DEFAULT_SETTINGS[key]),
+                            help=f'{help_text} (default {DEFAULT_SETTINGS[key]})')
+
+
+def check_settings(parser, settings):
+    '''Stops with an error message if a setting can not be rendered'''
+    for key in ('size_x', 'size_y', 'color_res_x', 'color_res_y',
+                'color_no_start', 'color_step_factor'):
+        if settings[key] < 1:
+            parser.error(f'{key} must be at least 1')
+    if not -50 <= settings['lightness'] <= 50:
+        parser.error('lightness must be between -50 and 50')
+    if not 380 <= settings['cent_lambda'] <= 750:
+        parser.error('cent_lambda must be between 380 and 750')
+
+
+def output_format(path, requested):
+    '''Returns the format to write, from the option or the file name'''
+    if requested:
+        return requested
+    return 'raw' if os.path.splitext(path)[1].lower() == '.raw' else 'png'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='computerrainbow render',
+        description='Renders an artwork to a file without opening a window. '
+                    'The color loss labels are only drawn by the program.')
+    settings_arguments(parser)
+    parser.add_argument('-o', '--output', required=True,
+                        help='file to write, a .png or .raw file')
+    parser.add_argument('--format', choices=('png', 'raw'),
+                        help='file format, by default taken from the output file name')
+    parser.add_argument('--indexed', action='store_true',
+                        help='write raw files with 8 or 16 bit palette positions '
+                             'instead of ARGB32 pixels')
+    parser.add_argument('--strip-height', type=int,
+                        help='rows rendered at a time (default about 32 MB worth)')
+    options = parser.parse_args(args)
+
+    settings = {key: getattr(options, key) for key in DEFAULT_SETTINGS}
+    check_settings(parser, settings)
+
+    def progress(done, total):
+        print(f'{100*done//total}%', end='\r', file=sys.stderr, flush=True)
+
+    # The image is rendered and written in strips, so images far larger
+    # than the memory of the machine can be rendered
+    start = time.perf_counter()
+    if output_format(options.output, options.format) == 'raw':
+        # Raw files are painted in place through a memory map
+        render_canvas(options.output, settings, options.indexed,
+                      options.strip_height, progress)
+    else:
+        export_image(options.output, settings, 'png', options.strip_height, progress)
+    print(f'Wrote {options.output} in {time.perf_counter() - start:.2f} s',
+          file=sys.stderr)
+    return 0
+
+
+def sweep_main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='computerrainbow sweep',
+        description='Renders every combination of the given settings into a '
+                    'directory, along with a manifest of the settings of each file. '
+                    'Settings take a value, a list like 6,12,24 or a range like '
+                    '400:700:10, where the end is included. Values starting with '
+                    'a minus are given as --lightness=-20:20:10.')
+    sweep_arguments(parser)
+    parser.add_argument('-o', '--output', required=True,
+                        help='directory to write the renders and manifest to')
+    parser.add_argument('--format', choices=('png', 'raw'), default='png',
+                        help='file format of the renders (default png)')
+    parser.add_argument('--workers', type=int,
+                        help='number of worker processes (default one per core)')
+    parser.add_argument('--restart', action='store_true',
+                        help='render everything again instead of skipping the '
+                             'renders finished by an earlier run')
+    options = parser.parse_args(args)
+
+    sweeps = dict()
+    for key in DEFAULT_SETTINGS:
+        try:
+            sweeps[key] = parse_values(getattr(options, key))
+        except ValueError:
+            parser.error(f'{key} must be a number, a list or a range')
+        if not sweeps[key]:
+            parser.error(f'the range for {key} is empty')
+        if key == 'color_bits_start' and not set(sweeps[key]) <= {6, 12, 24}:
+            parser.error('color_bits_start must be 6, 12 or 24')
+        for value in sweeps[key]:
+            check_settings(parser, dict(DEFAULT_SETTINGS, **{key: value}))
+    jobs = expand_grid(DEFAULT_SETTINGS, sweeps)
+
+    def progress(done, total):
+        print(f'{done}/{total}', end='\r', file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    records = run_sweep(jobs, options.output, options.format, options.workers,
+                        progress=progress, resume=not options.restart)
+    print(f'Rendered {len(records)} of {len(jobs)} images to {options.output} in '
+          f'{time.perf_counter() - start:.2f} s', file=sys.stderr)
+    return 0
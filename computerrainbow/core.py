@@ -0,0 +1,1039 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# The computations behind an artwork, from wavelengths to a NumPy array of
+# pixels. Nothing here uses Qt, so worker processes start quickly.
+import hashlib
+import json
+import multiprocessing
+import threading
+import os
+from math import ceil as ceil
+from math import floor as floor
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import numpy as np
+
+# The settings of an artwork, with the same defaults as the program
+DEFAULT_SETTINGS = {
+    'size_x': 800,
+    'size_y': 600,
+    'lightness': 0,
+    'cent_lambda': 560,
+    'color_bits_start': 24,
+    'color_res_x': 10,
+    'color_res_y': 10,
+    'color_no_start': 3,
+    'color_step_factor': 1,
+}
+
+
+def settings_key(settings):
+    '''Returns a hash of the settings that does not depend on the order of
+    the keys, for use as a cache key'''
+    canonical = json.dumps(sorted(settings.items()), separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+# Constants of the Bruton wavelength to RGB conversion
+GAMMA = 0.7999
+USHRT_MAX = 65535
+
+
+def lightness_factor(light):
+    '''Converts the lightness setting (-50 to 50) to the integer factor
+    passed to QColor.lighter'''
+    return int(100 + light*1.8)
+
+
+def spectrum_to_rgb(wavelengths):
+    '''Based on code found at http://www.noah.org/wiki/Wavelength_to_RGB_in_Python,
+    which again is based on FORTRAN code by Dan Bruton
+    http://www.physics.sfasu.edu/astro/color/spectra.html
+    Takes an array of wavelengths and returns three float arrays with the
+    gamma corrected red, green and blue intensities in the range 0 to 1.'''
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    R = np.zeros(wavelengths.shape)
+    G = np.zeros(wavelengths.shape)
+    B = np.zeros(wavelengths.shape)
+    # Each wavelength belongs to the first band it falls within, just like
+    # the if-elif chain in the scalar version
+    unassigned = np.ones(wavelengths.shape, dtype=bool)
+
+    def band(low, high):
+        mask = unassigned & (wavelengths >= low) & (wavelengths <= high)
+        unassigned[mask] = False
+        return mask, wavelengths[mask]
+
+    mask, w = band(380, 440)
+    attenuation = 0.2999 + 0.6999 * (w - 380) / (440 - 380)
+    R[mask] = ((-(w - 440) / (440 - 380)) * attenuation) ** GAMMA
+    B[mask] = (1.0 * attenuation) ** GAMMA
+    mask, w = band(440, 490)
+    G[mask] = ((w - 440) / (490 - 440)) ** GAMMA
+    B[mask] = 1.0
+    mask, w = band(490, 510)
+    G[mask] = 1.0
+    B[mask] = (-(w - 510) / (510 - 490)) ** GAMMA
+    mask, w = band(510, 580)
+    R[mask] = ((w - 510) / (580 - 510)) ** GAMMA
+    G[mask] = 1.0
+    mask, w = band(580, 645)
+    R[mask] = 1.0
+    G[mask] = (-(w - 645) / (645 - 580)) ** GAMMA
+    mask, w = band(645, 750)
+    attenuation = 0.3 + 0.7 * (750 - w) / (750 - 645)
+    R[mask] = (1.0 * attenuation) ** GAMMA
+    return R, G, B
+
+
+def quantize(channel, bits):
+    '''Reduces a float color channel in the range 0 to 1 to the 8 bit values
+    available at the given color depth'''
+    if bits == 24:
+        return (channel*255).astype(np.int64)
+    elif bits == 12:
+        return (15*channel).astype(np.int64)*17
+    elif bits == 6:
+        return (3*channel).astype(np.int64)*85
+    return channel.astype(np.int64)
+
+
+def _q_round(values):
+    # qRound for the positive values used in the HSV conversions
+    return np.floor(values + 0.5).astype(np.int64)
+
+
+def lighten(R, G, B, light):
+    '''Applies QColor.lighter(lightness_factor(light)) to arrays of 8 bit
+    channels and returns the result packed as 32 bit ARGB values.
+    The HSV round trip mirrors the one QColor does internally with
+    16 bit channels, so the results match QColor exactly.'''
+    factor = lightness_factor(light)
+    r = R.astype(np.int64)*257 / USHRT_MAX
+    g = G.astype(np.int64)*257 / USHRT_MAX
+    b = B.astype(np.int64)*257 / USHRT_MAX
+    high = np.maximum(np.maximum(r, g), b)
+    delta = high - np.minimum(np.minimum(r, g), b)
+    chromatic = delta > 1e-12
+    safe_delta = np.where(chromatic, delta, 1.0)
+
+    value = _q_round(high*USHRT_MAX)
+    saturation = np.where(chromatic,
+                          _q_round(delta / np.where(chromatic, high, 1.0) * USHRT_MAX),
+                          0)
+    hue = np.where(r == high, (g - b) / safe_delta,
+                   np.where(g == high, 2.0 + (b - r) / safe_delta,
+                            4.0 + (r - g) / safe_delta)) * 60.0
+    hue = np.where(hue < 0.0, hue + 360.0, hue)
+    hue = np.where(chromatic, _q_round(hue*100), USHRT_MAX)
+
+    # QColor.lighter hands factors below 100 on to QColor.darker
+    if factor <= 0:
+        pass
+    elif factor < 100:
+        value = value*100 // (10000 // factor)
+    else:
+        value = factor*value // 100
+        overflow = value > USHRT_MAX
+        saturation = np.where(overflow,
+                              np.maximum(saturation - (value - USHRT_MAX), 0),
+                              saturation)
+        value = np.minimum(value, USHRT_MAX)
+
+    # Back to RGB
+    h = np.where(hue == 36000, 0, hue) / 6000.0
+    s = saturation / USHRT_MAX
+    v = value / USHRT_MAX
+    sector = h.astype(np.int64)
+    f = h - sector
+    p = _q_round(v * (1.0 - s) * USHRT_MAX)
+    q = _q_round(v * (1.0 - (s * f)) * USHRT_MAX)
+    t = _q_round(v * (1.0 - (s * (1.0 - f))) * USHRT_MAX)
+    v = _q_round(v * USHRT_MAX)
+    sectors = [sector == i for i in range(6)]
+    r = np.select(sectors, [v, q, p, p, t, v])
+    g = np.select(sectors, [t, v, v, q, p, p])
+    b = np.select(sectors, [p, p, t, v, v, q])
+    achromatic = (saturation == 0) | (hue == USHRT_MAX)
+    r = np.where(achromatic, value, r)
+    g = np.where(achromatic, value, g)
+    b = np.where(achromatic, value, b)
+
+    # QColor rounds 16 bit channels to 8 bits with qt_div_257
+    def to_8_bit(channel):
+        channel = channel + 0x80
+        return (channel - (channel >> 8)) >> 8
+
+    return (0xff000000 | to_8_bit(r) << 16 | to_8_bit(g) << 8
+            | to_8_bit(b)).astype(np.uint32)
+
+
+def wavelengths_to_ARGB(wavelengths, light, bits):
+    '''Converts an array of wavelengths to an array of 32 bit ARGB values in
+    one pass. This is the exact conversion, which SpectralLUT approximates.'''
+    R, G, B = spectrum_to_rgb(wavelengths)
+    return lighten(quantize(R, bits), quantize(G, bits), quantize(B, bits), light)
+
+
+class SpectralLUT:
+    """ Precomputed wavelength to ARGB tables for the visible spectrum.
+    The spectrum from 380 to 750 nm is sampled samples_per_nm times per nm, and
+    a table of ARGB values for these samples is built the first time a
+    (lightness, bits) combination is asked for. The least recently used
+    tables are dropped when there are more than max_tables of them.
+
+    Wavelengths are looked up by rounding to the nearest sample. Interpolating
+    between samples would invent colors that are not available at the
+    requested color depth. The color returned for a wavelength is therefore
+    always the exact color of a wavelength at most half a sample spacing away,
+    and max_error gives the largest channel difference that can cause. """
+    start = 380
+    end = 750
+
+    def __init__(self, samples_per_nm=64, max_tables=16):
+        self.samples_per_nm = samples_per_nm
+        self.max_tables = max_tables
+        self.size = (self.end - self.start)*samples_per_nm + 1
+        # The extra sample past the end is used for all wavelengths outside
+        # the spectrum, which are black
+        self.sample_wavelengths = np.append(
+            self.start + np.arange(self.size)/samples_per_nm, 0)
+        self._tables = OrderedDict()
+        self._errors = dict()
+
+    def index(self, wavelengths):
+        '''Returns the sample index for each wavelength. Wavelengths outside
+        the spectrum are black, so they are sorted out before rounding, which
+        would put the ones just outside on the first or last sample.'''
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        position = np.rint((wavelengths - self.start)*self.samples_per_nm)
+        outside = (wavelengths < self.start) | (wavelengths > self.end)
+        return np.where(outside, self.size, position).astype(np.int64)
+
+    def table(self, light, bits):
+        '''Returns the ARGB values of all samples for the given lightness and
+        color depth'''
+        key = (light, bits)
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        table = wavelengths_to_ARGB(self.sample_wavelengths, light, bits)
+        self._tables[key] = table
+        if len(self._tables) > self.max_tables:
+            self._tables.popitem(last=False)
+        return table
+
+    def lookup(self, wavelengths, light, bits):
+        '''Returns ARGB values for an array of wavelengths'''
+        return self.table(light, bits)[self.index(wavelengths)]
+
+    def max_error(self, light, bits):
+        '''Measures the largest difference in any 8 bit channel between the
+        table and wavelengths_to_ARGB. The error is largest halfway between
+        samples, so the exact colors there are compared to both neighbours.'''
+        key = (light, bits)
+        if key not in self._errors:
+            table = self.table(light, bits)[:self.size]
+            midpoints = self.start + (np.arange(self.size - 1) + 0.5)/self.samples_per_nm
+            exact = wavelengths_to_ARGB(midpoints, light, bits)
+            error = 0
+            for neighbour in (table[:-1], table[1:]):
+                for shift in (16, 8, 0):
+                    difference = np.abs((exact >> shift & 0xff).astype(np.int64)
+                                        - (neighbour >> shift & 0xff))
+                    error = max(error, int(difference.max()))
+            self._errors[key] = error
+        return self._errors[key]
+
+
+# Lookup tables shared by all renders
+spectral_lut = SpectralLUT()
+
+
+def spectrum_wavelengths(no_of_colors, first, end):
+    '''Returns the wavelengths from index first up to end of the spectrum
+    from 380 to 740 nm split into no_of_colors evenly spaced wavelengths
+    around 560 nm. Any part of the spectrum can be made without the rest.'''
+    delta_l = 360/no_of_colors
+    mid_specter = 560
+    return mid_specter + delta_l*(np.arange(first, end) - (no_of_colors - 1)/2)
+
+
+def center_index(no_of_colors, center_wavelength):
+    '''Returns the index of the wavelength closest to center_wavelength when
+    the spectrum is split into no_of_colors wavelengths. Only the neighbours
+    of the fractional index can be closest. Ties go to the middle
+    wavelength, and otherwise to the lowest index.'''
+    delta_l = 360/no_of_colors
+    mid_specter = 560
+    i_middle = no_of_colors//2
+    position = (center_wavelength - mid_specter)/delta_l + (no_of_colors - 1)/2
+    first = min(max(int(floor(position)) - 1, 0), no_of_colors - 1)
+    last = min(max(int(ceil(position)) + 1, 0), no_of_colors - 1)
+    candidates = range(first, last + 1)
+    deviations = {i: abs(center_wavelength - (mid_specter + delta_l*(i - (no_of_colors - 1)/2)))
+                  for i in (i_middle, *candidates)}
+    deviation = min(deviations.values())
+    if deviations[i_middle] == deviation:
+        return i_middle
+    return min(i for i in candidates if deviations[i] == deviation)
+
+
+def wavelengths(no_of_colors, center_wavelength):
+    '''Splits the spectrum from 380 to 740 nm into no_of_colors evenly spaced
+    wavelengths around 560 nm. Returns them as a sorted array together with
+    the index of the wavelength closest to center_wavelength.'''
+    return (spectrum_wavelengths(no_of_colors, 0, no_of_colors),
+            center_index(no_of_colors, center_wavelength))
+
+
+def column_edges(size_x, color_res_x):
+    '''Returns the x coordinate where each column starts, followed by size_x.
+    All columns are color_res_x wide except the last, which is cut off at
+    the edge of the image.'''
+    no_columns = ceil(size_x/color_res_x)
+    return np.minimum(np.arange(no_columns + 1)*color_res_x, size_x)
+
+
+def row_partition(rows, size_y):
+    '''Splits the height of the image between the blocks of every column,
+    where rows holds the number of blocks in each column. Block k of a column
+    with n blocks starts at k*size_y//n, so block heights never differ by more
+    than one pixel and the blocks always end exactly at size_y. Returns a 2D
+    array with the row edges of each column, padded with size_y.'''
+    rows = np.asarray(rows, dtype=np.int64)[:, np.newaxis]
+    k = np.arange(rows.max(initial=0) + 1)
+    return np.minimum(k, rows)*size_y // rows
+
+
+def block_geometry(rows, size_x, size_y, color_res_x):
+    '''Lays out columns of color blocks on a size_x by size_y canvas, where
+    rows holds the number of blocks in each column. Returns the column edges
+    and the row edges from row_partition. Block j of column i covers
+    x_edges[i] <= x < x_edges[i + 1] and y_edges[i, j] <= y < y_edges[i, j + 1],
+    so the blocks never overlap and together cover every pixel once.'''
+    return column_edges(size_x, color_res_x), row_partition(rows, size_y)
+
+
+def block_rectangles(x_edges, y_edges, rows):
+    '''Turns the output of block_geometry into arrays with the left, top,
+    right and bottom edges of every block, one column after the other'''
+    blocks = np.arange(y_edges.shape[1] - 1) < np.asarray(rows)[:, np.newaxis]
+    left = np.broadcast_to(x_edges[:-1, np.newaxis], blocks.shape)[blocks]
+    right = np.broadcast_to(x_edges[1:, np.newaxis], blocks.shape)[blocks]
+    return left, y_edges[:, :-1][blocks], right, y_edges[:, 1:][blocks]
+
+
+class RenderCancelled(Exception):
+    '''Raised inside a render that has been replaced by a newer one'''
+
+
+class CancellationToken:
+    """ Lets one thread ask a render running in another thread to stop. The
+    render calls check() between pieces of work and stops with
+    RenderCancelled once cancel() has been called. """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise RenderCancelled()
+
+
+class RenderPipeline:
+    """ Keeps the results of a set of render stages between renders. Each stage
+    is a function that is called with the settings and the results of the
+    stages it depends on. A stage is only run again when one of the settings
+    keys it depends on has changed, or when a stage it depends on was run
+    again. Hits and misses are counted for every stage. Incremental stages are
+    also passed the settings and result of their last run, so they can update
+    the old result instead of starting over. A stage that hands back its old
+    result unchanged does not cause the stages after it to run again. """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.inputs = dict()
+        self.settings = dict()
+        self.results = dict()
+        self.versions = dict()
+        self.hits = dict()
+        self.misses = dict()
+
+    def add_stage(self, name, function, keys=(), upstream=(), cancellable=False,
+                  incremental=False):
+        self.stages[name] = (function, keys, upstream, cancellable, incremental)
+        self.versions[name] = 0
+        self.hits[name] = 0
+        self.misses[name] = 0
+
+    def run(self, settings, token=None):
+        '''Brings every stage up to date with the settings, running only the
+        stages whose inputs have changed since they last ran, and returns a
+        dictionary with the result of each stage. Stages must be added after
+        the stages they depend on. Stages added as cancellable are passed
+        the cancellation token, and the token is checked between stages.'''
+        for name, (function, keys, upstream, cancellable, incremental) in self.stages.items():
+            inputs = (tuple(settings[key] for key in keys),
+                      tuple(self.versions[stage] for stage in upstream))
+            if name in self.results and self.inputs[name] == inputs:
+                self.hits[name] += 1
+                # The result is just as valid for these settings, so the
+                # next run of an incremental stage compares with them and
+                # settings the stage does not use are not seen as changed
+                self.settings[name] = dict(settings)
+            else:
+                if token is not None:
+                    token.check()
+                self.misses[name] += 1
+                extra = {'token': token} if cancellable else {}
+                previous = None
+                if name in self.results:
+                    previous = (self.settings[name], self.results[name])
+                if incremental:
+                    extra['previous'] = previous
+                result = function(
+                    settings, *(self.results[stage] for stage in upstream), **extra)
+                self.inputs[name] = inputs
+                self.settings[name] = dict(settings)
+                if previous is None or result is not previous[1]:
+                    self.results[name] = result
+                    self.versions[name] += 1
+        return dict(self.results)
+
+    def stale_stages(self, settings):
+        '''Returns the names of the stages a run with settings would run
+        again, counting every stage after a stage that runs as stale, even
+        though an incremental stage may hand back its old result'''
+        stale = set()
+        for name, (function, keys, upstream, cancellable, incremental) in self.stages.items():
+            if (name not in self.results
+                    or self.inputs[name][0] != tuple(settings[key] for key in keys)
+                    or stale.intersection(upstream)):
+                stale.add(name)
+        return stale
+
+    def stats(self):
+        '''Returns a dictionary with the hits and misses of each stage'''
+        return {name: {'hits': self.hits[name], 'misses': self.misses[name]}
+                for name in self.stages}
+
+
+def changed_settings(settings, previous):
+    '''Returns the set of settings keys that differ from the settings of an
+    incremental stage's last run, or None when the stage has not run yet'''
+    if previous is None:
+        return None
+    previous_settings, previous_result = previous
+    return {key for key in settings if settings[key] != previous_settings.get(key)}
+
+
+def window_range(no_colors, center_wavelength, no_colors_max_displayed):
+    '''Returns the index of the first wavelength displayed in a column of
+    no_colors colors and the index after the last. When there are more
+    colors than fit in the column, the ones around the center wavelength
+    are shown.'''
+    half_color_span = no_colors_max_displayed // 2
+    no_colors = int(no_colors)
+    start_i = 0
+    end_i = no_colors
+    if no_colors > no_colors_max_displayed:
+        start_i = center_index(no_colors, center_wavelength) - half_color_span
+        if start_i < 0:
+            start_i = 0
+        end_i = start_i + no_colors_max_displayed
+        if end_i > no_colors:
+            end_i = no_colors + 1
+            start_i = end_i - no_colors_max_displayed
+    return start_i, min(end_i, no_colors)
+
+
+def column_window(no_colors, center_wavelength, no_colors_max_displayed):
+    '''Returns the wavelengths displayed in a column of no_colors colors'''
+    # Only the wavelengths shown are worked out, as columns can have
+    # many times more colors than fit in them
+    return spectrum_wavelengths(
+        int(no_colors), *window_range(no_colors, center_wavelength, no_colors_max_displayed))
+
+
+def wavelength_grid(settings, token=None, previous=None):
+    '''Returns a list with the number of colors in each column and a list
+    with the displayed wavelengths of each column. When only the size has
+    changed since the last run, the old columns are kept and only the new
+    ones are worked out.'''
+    size_x = settings["size_x"]
+    size_y = settings["size_y"]
+    center_wavelength = settings["cent_lambda"]
+    color_res_x = settings["color_res_x"]
+    color_res_y = settings["color_res_y"]
+    color_no_start = settings["color_no_start"]
+    color_step_factor = settings["color_step_factor"]
+
+    if size_x % color_res_x == 0:
+        color_steps = size_x // color_res_x - 1
+    else:
+        color_steps = size_x // color_res_x
+    no_of_colors_max = color_no_start + color_step_factor*color_steps
+    no_colors_max_displayed = ceil(size_y/color_res_y)
+
+    # Fill a list of lists with the wavelenghts for each section
+    # of the display
+    color_grid = list()
+    column_colors = list()
+    changed = changed_settings(settings, previous)
+    if changed is not None and changed <= {'size_x', 'size_y'}:
+        previous_settings, (previous_colors, previous_grid) = previous
+        if ceil(previous_settings["size_y"]/color_res_y) == no_colors_max_displayed:
+            # The columns are the same, there are just more or fewer of them
+            if len(previous_colors) == color_steps + 1:
+                return previous[1]
+            column_colors = previous_colors[:color_steps + 1]
+            color_grid = previous_grid[:color_steps + 1]
+
+    no_colors = color_no_start + color_step_factor*len(column_colors)
+    while no_colors <= no_of_colors_max:
+        if token is not None:
+            token.check()
+        color_grid.append(column_window(no_colors, center_wavelength, no_colors_max_displayed))
+        column_colors.append(int(no_colors))
+        no_colors = no_colors + color_step_factor
+    return column_colors, color_grid
+
+
+def grid_samples(settings, grid, previous=None):
+    '''Finds the spectral_lut sample of every block, all columns in one go.
+    Returns the samples used, the index into them for each block and the
+    number of blocks in each column. The indices are 8 bit when there are at
+    most 256 samples and 16 bit otherwise. When only the number of columns
+    has changed since the last run, the blocks of the old columns are kept
+    and samples seen for the first time are added to the end.'''
+    column_colors, color_grid = grid
+    rows = np.array([len(col) for col in color_grid])
+    changed = changed_settings(settings, previous)
+    if changed is not None and changed <= {'size_x', 'size_y'}:
+        previous_settings, (used_samples, block_index, previous_rows) = previous
+        kept = min(len(rows), len(previous_rows))
+        incremental = np.array_equal(rows[:kept], previous_rows[:kept])
+    else:
+        incremental = False
+
+    if incremental:
+        block_index = block_index[:rows[:kept].sum()]
+        if kept < len(rows):
+            samples = spectral_lut.index(np.concatenate(color_grid[kept:]))
+            used_samples = np.concatenate([used_samples, np.setdiff1d(samples, used_samples)])
+            sample_index = np.zeros(spectral_lut.size + 1, dtype=np.uint16)
+            sample_index[used_samples] = np.arange(len(used_samples))
+            block_index = np.concatenate([block_index, sample_index[samples]])
+    else:
+        samples = spectral_lut.index(np.concatenate(color_grid))
+        used_samples, block_index = np.unique(samples, return_inverse=True)
+    if len(used_samples) <= 256:
+        block_index = block_index.astype(np.uint8)
+    else:
+        block_index = block_index.astype(np.uint16)
+    return used_samples, block_index, rows
+
+
+def grid_palette(settings, samples):
+    '''Returns the ARGB color of each sample in use for the current
+    lightness and color depth'''
+    used_samples, block_index, rows = samples
+    return spectral_lut.table(settings["lightness"], settings["color_bits_start"])[used_samples]
+
+
+def grid_geometry(settings, samples):
+    used_samples, block_index, rows = samples
+    return block_geometry(rows, settings["size_x"], settings["size_y"], settings["color_res_x"])
+
+
+class ColumnCache:
+    """ A least recently used cache of rendered columns. A column only
+    depends on its number of colors, the center wavelength, the image height
+    and the block height, not on where in the image it is. Columns are
+    stored as one spectral_lut sample per pixel row, so they can be reused
+    for any lightness and color depth. The cache is limited to max_bytes. """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.columns = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        column = self.columns.get(key)
+        if column is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.columns.move_to_end(key)
+        return column
+
+    def put(self, key, column):
+        if column.nbytes > self.max_bytes:
+            return
+        column.flags.writeable = False
+        self.columns[key] = column
+        self.bytes += column.nbytes
+        while self.bytes > self.max_bytes:
+            key, old_column = self.columns.popitem(last=False)
+            self.bytes -= old_column.nbytes
+
+    def __contains__(self, key):
+        # Looking does not count as a hit or a miss
+        return key in self.columns
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    columns=len(self.columns), bytes=self.bytes)
+
+
+# Rendered columns shared by all renders
+column_cache = ColumnCache()
+
+
+def uncached_columns(settings):
+    '''Returns how many columns of the image for settings are not in the
+    column_cache, and how many columns there are'''
+    no_columns = ceil(settings["size_x"]/settings["color_res_x"])
+    fixed = (settings["cent_lambda"], settings["size_y"], settings["color_res_y"])
+    missing = sum((settings["color_no_start"] + settings["color_step_factor"]*i,) + fixed
+                  not in column_cache for i in range(no_columns))
+    return missing, no_columns
+
+
+def index_image(settings, grid, samples, geometry, token=None, previous=None):
+    '''Composes an image where each pixel holds the index of its color in
+    the palette, and returns it with the samples the indices refer to.
+    Columns are taken from the column_cache when possible, so only new
+    columns are rendered. When only the width has changed since the last
+    run, the old image is cropped, or its columns are kept and the new
+    columns added on the right.'''
+    size_x = settings["size_x"]
+    size_y = settings["size_y"]
+    column_colors, color_grid = grid
+    used_samples, block_index, rows = samples
+    x_edges, y_edges = geometry
+
+    image = None
+    first_column = 0
+    changed = changed_settings(settings, previous)
+    if changed is not None and changed <= {'size_x'}:
+        previous_settings, (previous_samples, previous_image) = previous
+        # The old indices are only valid if the old samples are still
+        # at the start of the samples in use
+        if np.array_equal(used_samples[:len(previous_samples)], previous_samples):
+            previous_x = previous_settings["size_x"]
+            if size_x <= previous_x:
+                return used_samples, previous_image[:, :size_x].astype(block_index.dtype)
+            # The last old column may have been cut off by the old edge
+            first_column = previous_x // settings["color_res_x"]
+            image = np.empty((size_y, size_x), dtype=block_index.dtype)
+            image[:, :x_edges[first_column]] = previous_image[:, :x_edges[first_column]]
+    if image is None:
+        image = np.empty((size_y, size_x), dtype=block_index.dtype)
+
+    # Maps spectral_lut samples to palette indices
+    palette_index = np.zeros(spectral_lut.size + 1, dtype=block_index.dtype)
+    palette_index[used_samples] = np.arange(len(used_samples))
+    first_blocks = np.cumsum(rows) - rows
+
+    for i in range(first_column, len(column_colors)):
+        if token is not None:
+            token.check()
+        first = first_blocks[i]
+        column = column_strip(settings, column_colors[i],
+                              used_samples[block_index[first:first + rows[i]]],
+                              np.diff(y_edges[i, :rows[i] + 1]))
+        image[:, x_edges[i]:x_edges[i + 1]] = palette_index[column][:, np.newaxis]
+    return used_samples, image
+
+
+def column_strip(settings, no_colors, block_samples, heights):
+    '''Returns the spectral_lut sample of every pixel row of a column, where
+    block_samples and heights are the sample and height of each of its
+    blocks. Columns are kept in the column_cache.'''
+    key = (no_colors, settings["cent_lambda"], settings["size_y"], settings["color_res_y"])
+    column = column_cache.get(key)
+    if column is None:
+        column = np.repeat(block_samples.astype(np.uint16), heights)
+        column_cache.put(key, column)
+    return column
+
+
+def column_order(x_edges, left, right):
+    '''Returns the columns in the order they are likely to be looked at:
+    the ones between x positions left and right first, then the others by
+    their distance from them, the ones to the right before the ones to the
+    left at the same distance. Also returns how many columns are between
+    left and right.'''
+    starts = x_edges[:-1]
+    ends = x_edges[1:]
+    to_the_left = ends <= left
+    distance = np.where(to_the_left, left - ends + 1, np.maximum(starts - right + 1, 0))
+    order = np.lexsort((to_the_left, distance))
+    return order, int(np.count_nonzero(distance == 0))
+
+
+def paint_columns(pixels, settings, results, columns, token=None):
+    '''Paints some of the columns of an image straight into a 2D ARGB array,
+    from the results of a rainbow_pipeline run. Columns are painted in the
+    order given.'''
+    column_colors, color_grid = results['wavelengths']
+    used_samples, block_index, rows = results['rgb']
+    x_edges, y_edges = results['geometry']
+    table = spectral_lut.table(settings["lightness"], settings["color_bits_start"])
+    first_blocks = np.cumsum(rows) - rows
+    for i in columns:
+        if token is not None:
+            token.check()
+        first = first_blocks[i]
+        column = column_strip(settings, column_colors[i],
+                              used_samples[block_index[first:first + rows[i]]],
+                              np.diff(y_edges[i, :rows[i] + 1]))
+        pixels[:, x_edges[i]:x_edges[i + 1]] = table[column][:, np.newaxis]
+
+
+def percent_unique(colors):
+    '''Returns the share of the blocks in a column with a color of their own'''
+    return round(len(np.unique(colors))*100/len(colors))
+
+
+def loss_labels(x_edges, percents):
+    '''Returns the x positions of the columns where the share of unique
+    colors first drops below 90%, 80% and so on'''
+    color_loss_limit = 90 # First label at 90% unique
+    label_list = list()
+    for x, percent in zip(x_edges, percents):
+        # We want a label informing of resolution loss when 10% or more 
+        # of the boxes in one column have the same RGB code
+        if percent < color_loss_limit + 1:
+            label_list.append(int(x))
+            color_loss_limit = color_loss_limit - 10
+    return label_list
+
+
+def color_loss_labels(settings, samples, palette, geometry, token=None):
+    '''Returns the x positions of the color loss labels'''
+    used_samples, block_index, rows = samples
+    x_edges, y_edges = geometry
+    color_grid = np.split(palette[block_index], np.cumsum(rows)[:-1])
+
+    percents = list()
+    for col in color_grid:
+        if token is not None:
+            token.check()
+        percents.append(percent_unique(col))
+    return loss_labels(x_edges, percents)
+
+
+def rainbow_pipeline(rasterization=True, labels=True):
+    '''Returns a RenderPipeline with the stages of a rainbow render. Lightness
+    and color bits only change the palette, so the stages leading up to the
+    index image are skipped when only they change. Without the rasterization
+    stage, the image is left to be painted with paint_columns. The labels
+    stage is left out when the labels are not drawn, as for files.'''
+    pipeline = RenderPipeline()
+    pipeline.add_stage('wavelengths', wavelength_grid,
+                       keys=('size_x', 'size_y', 'cent_lambda', 'color_res_x',
+                             'color_res_y', 'color_no_start', 'color_step_factor'),
+                       cancellable=True, incremental=True)
+    pipeline.add_stage('rgb', grid_samples, upstream=('wavelengths',),
+                       incremental=True)
+    pipeline.add_stage('quantization', grid_palette,
+                       keys=('lightness', 'color_bits_start'), upstream=('rgb',))
+    pipeline.add_stage('geometry', grid_geometry,
+                       keys=('size_x', 'size_y', 'color_res_x'), upstream=('rgb',))
+    if rasterization:
+        pipeline.add_stage('rasterization', index_image,
+                           upstream=('wavelengths', 'rgb', 'geometry'),
+                           cancellable=True, incremental=True)
+    if labels:
+        pipeline.add_stage('labels', color_loss_labels,
+                           upstream=('rgb', 'quantization', 'geometry'),
+                           cancellable=True)
+    return pipeline
+
+
+def compose(pixels, results):
+    '''Paints the image from the results of a rainbow_pipeline run into a 2D
+    ARGB array. Returns the x positions of the color loss labels and the
+    color the label dots are filled with, as the labels themselves need a
+    font to be drawn. There are no labels without the labels stage.'''
+    used_samples, block_index, rows = results['rgb']
+    palette = results['quantization']
+    pixels[:, :] = palette[results['rasterization'][1]]
+    return results.get('labels', []), palette[block_index[-1]]
+
+
+def render(settings, token=None, labels=True):
+    '''Renders an artwork without keeping anything between renders. Returns
+    a new size_y by size_x array of ARGB pixels, the x positions of the
+    color loss labels and the color of the label dots.'''
+    results = rainbow_pipeline(labels=labels).run(settings, token)
+    pixels = np.empty((settings["size_y"], settings["size_x"]), dtype=np.uint32)
+    label_list, dot_color = compose(pixels, results)
+    return pixels, label_list, dot_color
+
+
+def preview_settings(settings, factor):
+    '''Returns settings for a coarse approximation of settings that is about
+    factor times smaller in both directions, to be scaled up to the full size.
+    Blocks shrink with the image down to one pixel. Beyond that neighbouring
+    columns are merged by stepping the number of colors faster, and fewer
+    colors are shown in each column.'''
+    color_res_x = max(1, settings["color_res_x"]//factor)
+    merged = max(1, factor*color_res_x//settings["color_res_x"])
+    no_columns = ceil(ceil(settings["size_x"]/settings["color_res_x"])/merged)
+    color_res_y = max(1, settings["color_res_y"]//factor)
+    no_colors_max_displayed = ceil(settings["size_y"]/settings["color_res_y"])
+    return dict(settings,
+                size_x=no_columns*color_res_x,
+                size_y=min(no_colors_max_displayed*color_res_y, ceil(settings["size_y"]/factor)),
+                color_res_x=color_res_x,
+                color_res_y=color_res_y,
+                color_step_factor=settings["color_step_factor"]*merged)
+
+
+def preview_factors(settings, max_pixels=65536):
+    '''Returns how much smaller each pass of a coarse to fine preview of
+    settings is, coarsest first. The factor of the first pass is raised until
+    preview_settings gives it at most max_pixels pixels, and each pass is
+    made with a quarter of the factor of the one before. Images with fewer
+    than 16*max_pixels pixels are fast enough to need no preview.'''
+    pixels = settings["size_x"]*settings["size_y"]
+    if pixels < 16*max_pixels:
+        return []
+    factors = [4]
+    while True:
+        coarsest = preview_settings(settings, factors[0])
+        if coarsest["size_x"]*coarsest["size_y"] <= max_pixels:
+            return factors
+        factors.insert(0, factors[0]*4)
+
+
+def column_windows(settings, token=None):
+    '''Returns the number of colors in each column, the index of the first
+    wavelength it displays and its number of blocks, as three arrays. This
+    is all it takes to work out the color of any pixel.'''
+    no_colors_max_displayed = ceil(settings["size_y"]/settings["color_res_y"])
+    no_columns = ceil(settings["size_x"]/settings["color_res_x"])
+    no_colors = settings["color_no_start"] + settings["color_step_factor"]*np.arange(no_columns)
+    first = np.empty(no_columns, dtype=np.int64)
+    rows = np.empty(no_columns, dtype=np.int64)
+    for i in range(no_columns):
+        if token is not None and i % 1024 == 0:
+            token.check()
+        start_i, end_i = window_range(no_colors[i], settings["cent_lambda"],
+                                      no_colors_max_displayed)
+        first[i] = start_i
+        rows[i] = end_i - start_i
+    return no_colors, first, rows
+
+
+def strip_samples(settings, windows, y, end_y):
+    '''Returns the spectral_lut sample of every block in the rows from y up
+    to end_y, one row of blocks for each pixel row, where windows is the
+    output of column_windows'''
+    no_colors, first, rows = windows
+    strip_rows = np.arange(y, end_y)[:, np.newaxis]
+    # Block k of a column with n blocks starts at row k*size_y//n, so
+    # row y is in block ((y + 1)*n - 1)//size_y
+    block = ((strip_rows + 1)*rows - 1)//settings["size_y"]
+    # The same steps as spectrum_wavelengths, so the wavelengths are
+    # exactly those of a render held in memory
+    delta_l = 360/no_colors
+    mid_specter = 560
+    return spectral_lut.index(mid_specter + delta_l*((first + block) - (no_colors - 1)/2))
+
+
+def used_samples(settings, windows, token=None):
+    '''Returns the sorted spectral_lut samples used by any block. Columns
+    are gone through one at a time.'''
+    used = np.zeros(spectral_lut.size + 1, dtype=bool)
+    for i, (no_colors, start_i, rows) in enumerate(zip(*windows)):
+        if token is not None and i % 1024 == 0:
+            token.check()
+        used[spectral_lut.index(spectrum_wavelengths(int(no_colors), start_i,
+                                                     start_i + rows))] = True
+    return np.flatnonzero(used)
+
+
+def indexed_palette(settings, windows, token=None):
+    '''Returns the palette of an indexed image and the position in it of
+    the color of every spectral_lut sample. Positions are 8 bit when there
+    are at most 256 colors and 16 bit otherwise.'''
+    samples = used_samples(settings, windows, token)
+    palette = spectral_lut.table(settings["lightness"], settings["color_bits_start"])[samples]
+    positions = np.zeros(spectral_lut.size + 1,
+                         dtype=np.uint8 if len(palette) <= 256 else np.uint16)
+    positions[samples] = np.arange(len(samples))
+    return palette, positions
+
+
+def block_strips(settings, windows, values, strip_height=None, token=None):
+    '''Paints an image a strip of rows at a time, where values holds the
+    pixel value of every spectral_lut sample. Yields the first row of each
+    strip and its pixels. Only the strip and a few numbers per column are
+    in memory at a time, so the memory used does not depend on the number
+    of blocks. Strips are about 32 MB unless strip_height is given.'''
+    size_x = settings["size_x"]
+    size_y = settings["size_y"]
+    widths = np.diff(column_edges(size_x, settings["color_res_x"]))
+    if strip_height is None:
+        # The block numbers, wavelengths and samples of a strip take about
+        # 32 bytes per column and row
+        strip_height = max(1, (32 << 20) // (size_x*values.itemsize + len(widths)*32))
+
+    for y in range(0, size_y, strip_height):
+        if token is not None:
+            token.check()
+        samples = strip_samples(settings, windows, y, min(y + strip_height, size_y))
+        yield y, np.repeat(values[samples], widths, axis=1)
+
+
+def render_strips(settings, strip_height=None, token=None):
+    '''Renders an artwork a strip of rows at a time, for images too large to
+    hold in memory. Yields the first row of each strip and its ARGB pixels.'''
+    windows = column_windows(settings, token)
+    table = spectral_lut.table(settings["lightness"], settings["color_bits_start"])
+    yield from block_strips(settings, windows, table, strip_height, token)
+
+
+def render_band(settings, first_column, end_column, buffer_name):
+    '''Renders the columns from first_column up to end_column straight into
+    the shared memory pixel buffer called buffer_name. Runs in a worker
+    process. Returns the share of unique colors in each column and the
+    color of the last block.'''
+    size_x = settings["size_x"]
+    size_y = settings["size_y"]
+    color_res_x = settings["color_res_x"]
+    no_colors_max_displayed = ceil(size_y/settings["color_res_y"])
+    table = spectral_lut.table(settings["lightness"], settings["color_bits_start"])
+    x_edges = column_edges(size_x, color_res_x)
+
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+    try:
+        pixels = np.ndarray((size_y, size_x), dtype=np.uint32, buffer=buffer.buf)
+        percents = list()
+        for i in range(first_column, end_column):
+            no_colors = settings["color_no_start"] + settings["color_step_factor"]*i
+            window = column_window(no_colors, settings["cent_lambda"], no_colors_max_displayed)
+            colors = table[spectral_lut.index(window)]
+            y_edges = row_partition([len(colors)], size_y)[0]
+            column = np.repeat(colors, np.diff(y_edges))
+            pixels[:, x_edges[i]:x_edges[i + 1]] = column[:, np.newaxis]
+            percents.append(percent_unique(colors))
+        del pixels
+    finally:
+        buffer.close()
+    return percents, colors[-1]
+
+
+class BandRenderer:
+    """ Renders large images in a pool of worker processes. The image is
+    split into bands of whole columns, and each worker writes its bands
+    straight into the shared memory behind the image, so no pixels are
+    copied between processes. The pool is started the first time it is
+    needed. Workers are spawned rather than forked, as forking a process
+    running Qt threads is not safe. """
+
+    def __init__(self, workers=None, min_pixels=1000000):
+        self.workers = workers or os.cpu_count() or 1
+        # Smaller images are rendered faster than the work can be handed out
+        self.min_pixels = min_pixels
+        self.executor = None
+        # Set when the workers died, after which everything is rendered
+        # in this process
+        self.broken = False
+
+    def enabled(self, settings):
+        '''Tells if the image for settings is best rendered in the workers.
+        The workers do not use the column_cache, so the image is only handed
+        to them when most of its columns would have to be rendered anyway.'''
+        if (self.workers == 1 or self.broken
+                or settings["size_x"]*settings["size_y"] < self.min_pixels):
+            return False
+        missing, no_columns = uncached_columns(settings)
+        return 2*missing > no_columns
+
+    def render(self, settings, buffer_name, token=None, visible_x=None, progress=None):
+        '''Renders the image for settings into the shared memory buffer.
+        Returns the x positions of the color loss labels and the color of
+        the last block. Raises RenderCancelled when the token is cancelled,
+        after waiting for the bands already being rendered. Raises
+        BrokenProcessPool when a worker dies, and is disabled from then on.
+        The bands between the x positions in visible_x are handed out first,
+        and the others in the order of column_order. progress is called
+        whenever bands have been finished, with the number of bands in view
+        and the number of bands in all that are not finished yet.'''
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'))
+        x_edges = column_edges(settings["size_x"], settings["color_res_x"])
+        no_columns = len(x_edges) - 1
+        # A few bands per worker evens out bands of unequal cost
+        no_bands = min(no_columns, self.workers*4)
+        band_edges = [k*no_columns//no_bands for k in range(no_bands + 1)]
+        if visible_x is None:
+            order, no_visible = range(no_bands), no_bands
+        else:
+            order, no_visible = column_order(x_edges[band_edges], *visible_x)
+        # The pool starts the bands in the order they are submitted
+        futures = [None]*no_bands
+        for band in order:
+            futures[band] = self.executor.submit(render_band, settings, band_edges[band],
+                                                 band_edges[band + 1], buffer_name)
+        visible = {futures[band] for band in order[:no_visible]}
+        try:
+            pending = futures
+            while pending:
+                if token is not None:
+                    token.check()
+                done, pending = wait(pending, timeout=0.05)
+                if done and progress is not None:
+                    progress(len(visible & pending), len(pending))
+        except RenderCancelled:
+            for future in futures:
+                future.cancel()
+            # Running bands still write into the buffer, so it can not be
+            # handed out again before they are done
+            wait(futures)
+            raise
+        percents = list()
+        try:
+            for future in futures:
+                band_percents, dot_color = future.result()
+                percents.extend(band_percents)
+        except BrokenProcessPool:
+            self.broken = True
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            raise
+        return loss_labels(x_edges, percents), dot_color
+
@@ -0,0 +1,73 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# Exports artworks of any size. The image is rendered a strip of rows at a
+# time and each strip is written out before the next is rendered, so the
+# memory used does not grow with the height of the image.
+from .core import block_strips, column_windows, indexed_palette, render_strips, spectral_lut
+from .pngimage import PNGWriter
+from .rawimage import ARGB32, RawCanvas, RawWriter, indexed_format
+
+
+def export_image(path, settings, file_format='png', strip_height=None, progress=None,
+                 token=None):
+    '''Renders the artwork for settings straight to a PNG or raw file at
+    path. progress is called with the number of rows written and the height
+    of the image. The file only appears at path once it is complete.'''
+    size_x = settings["size_x"]
+    size_y = settings["size_y"]
+    if file_format == 'raw':
+        writer = RawWriter(path, size_x, size_y, settings)
+    else:
+        writer = PNGWriter(path, size_x, size_y)
+    try:
+        for y, pixels in render_strips(settings, strip_height, token):
+            writer.write_rows(pixels)
+            if progress is not None:
+                progress(y + len(pixels), size_y)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def render_canvas(path, settings, indexed=False, strip_height=None, progress=None,
+                  token=None):
+    '''Renders the artwork for settings straight into a memory mapped raw
+    image at path, with ARGB32 pixels or, if indexed, 8 or 16 bit positions
+    in a palette. Each strip is written back to the file once painted, so
+    the image does not have to fit in memory.'''
+    windows = column_windows(settings, token)
+    if indexed:
+        palette, values = indexed_palette(settings, windows, token)
+        pixel_format = indexed_format(palette)
+    else:
+        palette = None
+        values = spectral_lut.table(settings["lightness"], settings["color_bits_start"])
+        pixel_format = ARGB32
+    canvas = RawCanvas(path, settings["size_x"], settings["size_y"], settings,
+                       pixel_format, palette)
+    try:
+        for y, pixels in block_strips(settings, windows, values, strip_height, token):
+            canvas.pixels[y:y + len(pixels)] = pixels
+            canvas.flush()
+            if progress is not None:
+                progress(y + len(pixels), settings["size_y"])
+    except BaseException:
+        canvas.abort()
+        raise
+    canvas.close()
@@ -25,6 +25,8 @@ from PyQt5 import QtGui as qtg
 from PyQt5 import QtCore as qtc
 
 from .rainbow_model import RainbowModel
+from .rawimage import RawImageError, open_raw
+from .tiled_view import TiledView
 from .settings_dialog import SettingsDialog
 from .images import resources
 
@@ -32,6 +34,7 @@ from .images import resources
 class MainWindow(qtw.QMainWindow):
 
     changed = qtc.pyqtSignal(dict)
+    canvas_requested = qtc.pyqtSignal(str, dict, bool)
     def __init__(self):
         """MainWindowConstructor"""
         super().__init__()
@@ -136,10 +139,12 @@ class MainWindow(qtw.QMainWindow):
         self.colors_step = qtw.QSpinBox(self, maximum=16, minimum=1)
 
         self.rainbow_model = RainbowModel(self, self.current_settings)
-        self.rainbow_view = qtw.QLabel(pixmap = qtg.QPixmap(self.image))
-
-        rainbow_box = qtw.QScrollArea()
-        rainbow_box.setWidget(self.rainbow_view)
+        # The view only converts the parts of the image that are scrolled
+        # into view, so it is shown the image rather than a copy of it
+        self.rainbow_view = TiledView()
+        self.rainbow_view.set_image(self.image)
+        # The image from the model that is being shown
+        self.shown_image = None
 
         button_values = 6, 12, 24
         self.color_bits_start_button_list = list()
@@ -196,7 +201,7 @@ class MainWindow(qtw.QMainWindow):
 
 
         third_col = qtw.QVBoxLayout()
-        third_col.addWidget(rainbow_box)
+        third_col.addWidget(self.rainbow_view)
 
         color_res_box = qtw.QGroupBox('Color bits')
         color_res_area = qtw.QHBoxLayout()
@@ -222,10 +227,14 @@ class MainWindow(qtw.QMainWindow):
         # Create thread for RainbowModel and connect its signals
         self.render_thread = qtc.QThread()
         self.rainbow_model.moveToThread(self.render_thread)
-        self.rainbow_model.finished.connect(self.render_thread.quit)
         self.render_thread.start()
         self.rainbow_model.rendering.connect(self.rendering_view)
         self.rainbow_model.finished.connect(self.finished_view)
+        self.canvas_requested.connect(self.rainbow_model.render_to_canvas)
+        self.rainbow_model.canvas_finished.connect(self.canvas_view)
+        self.rainbow_model.canvas_failed.connect(self.canvas_failed)
+        # The memory map behind a canvas that is being shown
+        self.canvas_pixels = None
 
         # Add menus and connect them
         menubar = self.menuBar()
@@ -236,6 +245,10 @@ class MainWindow(qtw.QMainWindow):
         about_action = app_menu.addAction('About Rainbow', self.show_about_dialog)
         app_menu.addSeparator()
         pref_action = app_menu.addAction('Preferences...', self.show_pref_dialog)
+        app_menu.addSeparator()
+        export_action = app_menu.addAction('Export canvas...', self.export_canvas)
+        open_action = app_menu.addAction('Open canvas...', self.open_canvas)
+        app_menu.addSeparator()
         quit_action = app_menu.addAction('Quit Rainbow', self.destroy)
 
 
@@ -247,24 +260,50 @@ class MainWindow(qtw.QMainWindow):
         self.lambda_spin.valueChanged.connect(self.on_lambda_change)
         self.colors_step.valueChanged.connect(self.on_colors_step_change)
         color_bits_start_group.buttonClicked.connect(self.on_color_bits_start_change)
-        self.changed.connect(self.render_thread.start)
-        self.changed.connect(self.rainbow_model.render)
+        # request_render has to run in this thread, so that new settings
+        # replace the pending ones while the render thread is busy
+        self.changed.connect(self.rainbow_model.request_render, qtc.Qt.DirectConnection)
+        self.changed.connect(self.render_started)
+        # The model paints what is in view first, and has to know about
+        # scrolling while it renders
+        self.rainbow_view.viewport_changed.connect(self.rainbow_model.set_viewport,
+                                                   qtc.Qt.DirectConnection)
 
         # End main UI code
         self.show()
         self.changed.emit(self.current_settings)
 
-    def rendering_view(self, image):
+    def render_started(self, settings):
+        # The view shows that the image is being rendered, so the model
+        # does not have to make an image for it
         self.statusBar().showMessage('Rendering image.')
+        self.rainbow_view.set_busy('RENDERING')
+
+    def rendering_view(self, image):
         self.update_view(image)
 
     def finished_view(self, image):
         self.statusBar().showMessage('Computer Rainbow! by NAITA Software')
+        self.rainbow_view.set_busy(None)
         self.update_view(image)
 
+    def canvas_view(self, path):
+        self.statusBar().showMessage(f'Canvas written to {path}')
+
+    def canvas_failed(self, path, error):
+        self.statusBar().showMessage(f'Could not write canvas to {path}')
+        qtw.QMessageBox.warning(self, 'Export canvas', error)
+
     def update_view(self, image):
-        self.rainbow_view.setPixmap(qtg.QPixmap(image))
-        self.rainbow_view.resize(image.width(), image.height())
+        self.rainbow_view.set_image(image)
+        self.show_model_image(image)
+
+    def show_model_image(self, image):
+        # The view reads from the image it shows, so the image the model
+        # sent before is only handed back to it once the view has moved on
+        previous, self.shown_image = self.shown_image, image
+        if previous is not None:
+            self.rainbow_model.release_image(previous)
 
     def on_light_change(self, light):
         if light != self.current_settings['lightness']:
@@ -324,6 +363,28 @@ class MainWindow(qtw.QMainWindow):
 '''
         )
 
+    def export_canvas(self):
+        path, _ = qtw.QFileDialog.getSaveFileName(
+            self, 'Export canvas', 'rainbow.raw', 'Raw canvas (*.raw)')
+        if path:
+            self.statusBar().showMessage(f'Writing canvas to {path}')
+            # Canvases hold palette positions, which take a quarter of the space
+            self.canvas_requested.emit(path, dict(self.current_settings), True)
+
+    def open_canvas(self):
+        path, _ = qtw.QFileDialog.getOpenFileName(
+            self, 'Open canvas', '', 'Raw canvas (*.raw)')
+        if path:
+            try:
+                header, self.canvas_pixels = open_raw(path)
+            except (OSError, ValueError, RawImageError) as error:
+                qtw.QMessageBox.warning(self, 'Open canvas', str(error))
+                return
+            # Tiles are read from the file as they are scrolled into view
+            self.rainbow_view.set_canvas(header, self.canvas_pixels)
+            self.show_model_image(None)
+            self.statusBar().showMessage(f'Showing {path}')
+
     def show_pref_dialog(self):
         settings_dialog = SettingsDialog(self, self.settings, self.current_settings)
         if settings_dialog.exec():
@@ -0,0 +1,102 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# Writes PNG files without Qt, so renders can be saved on machines with no
+# display. Rows are compressed as they are written, so an image never has to
+# be held in memory as a whole.
+import os
+import struct
+import zlib
+import numpy as np
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Compressed data is written in IDAT chunks of about this size
+CHUNK_SIZE = 1 << 20
+
+
+def png_chunk(chunk_type, data):
+    '''Returns a PNG chunk with its length and checksum'''
+    return (struct.pack('>I', len(data)) + chunk_type + data
+            + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+class PNGWriter:
+    """ Writes an 8 bit RGB or RGBA PNG one strip of rows at a time. The rows
+    are ARGB32 pixels, as used everywhere else in the program. The file is
+    written under a temporary name and only moved to path by close(), so a
+    crash never leaves a partial file at path. """
+
+    def __init__(self, path, width, height, alpha=False, level=6):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.alpha = alpha
+        self.rows = 0
+        self.compressor = zlib.compressobj(level)
+        self.pending = list()
+        self.pending_size = 0
+        self.file = open(path + '.part', 'wb')
+        color_type = 6 if alpha else 2
+        self.file.write(SIGNATURE)
+        self.file.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                                       8, color_type, 0, 0, 0)))
+
+    def write_rows(self, pixels):
+        '''Compresses a 2D array of ARGB32 pixel rows'''
+        if pixels.shape[1] != self.width or self.rows + len(pixels) > self.height:
+            raise ValueError('rows do not fit the image')
+        argb = np.ascontiguousarray(pixels, dtype=np.uint32)
+        # ARGB32 is stored as BGRA bytes on little endian machines
+        bgra = argb.astype('<u4').view(np.uint8).reshape(len(argb), self.width, 4)
+        channels = [2, 1, 0, 3] if self.alpha else [2, 1, 0]
+        # Every row starts with filter type 0, no filtering
+        scanlines = np.zeros((len(argb), 1 + self.width*len(channels)), dtype=np.uint8)
+        scanlines[:, 1:] = bgra[:, :, channels].reshape(len(argb), -1)
+        self.add_data(self.compressor.compress(scanlines.tobytes()))
+        self.rows += len(pixels)
+
+    def add_data(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= CHUNK_SIZE:
+            self.file.write(png_chunk(b'IDAT', b''.join(self.pending)))
+            self.pending = list()
+            self.pending_size = 0
+
+    def close(self):
+        '''Finishes the file and moves it into place'''
+        if self.rows != self.height:
+            self.abort()
+            raise ValueError(f'{self.rows} of {self.height} rows were written')
+        self.pending.append(self.compressor.flush())
+        self.file.write(png_chunk(b'IDAT', b''.join(self.pending)))
+        self.file.write(png_chunk(b'IEND', b''))
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+    def abort(self):
+        '''Closes and removes the unfinished file'''
+        self.file.close()
+        os.remove(self.path + '.part')
+
+
+def write_png(path, pixels, alpha=False):
+    '''Writes a 2D array of ARGB32 pixels to path as a PNG'''
+    height, width = pixels.shape
+    writer = PNGWriter(path, width, height, alpha)
+    writer.write_rows(pixels)
+    writer.close()
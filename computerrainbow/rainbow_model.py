@@ -19,9 +19,198 @@
 from PyQt5 import QtWidgets as qtw 
 from PyQt5 import QtGui as qtg 
 from PyQt5 import QtCore as qtc
-from time import sleep
-from math import ceil as ceil
-from math import floor as floor
+from PyQt5 import sip
+from time import monotonic, sleep
+import atexit
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import threading
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+# The rendering itself is done by the Qt free core
+from .core import (BandRenderer, CancellationToken, RenderCancelled, column_cache,
+                   column_order, paint_columns, preview_factors, preview_settings,
+                   rainbow_pipeline, render, settings_key, spectral_lut, wavelengths)
+from .export import render_canvas
+from .render_cache import DiskRenderCache, RenderCache
+
+
+def image_pixels(image, writable=True):
+    '''Returns a NumPy view of the pixels in a 32 bit QImage. A read only
+    view does not detach an image that is shared with a copy.'''
+    pointer = image.bits() if writable else image.constBits()
+    pointer.setsize(image.sizeInBytes())
+    pixels = np.frombuffer(pointer, dtype=np.uint32)
+    return pixels.reshape(image.height(), image.bytesPerLine()//4)[:, :image.width()]
+
+
+class RenderScheduler:
+    """ Hands settings from the GUI thread to the render thread, keeping only
+    the newest. Submitting new settings cancels the render in progress, so
+    a burst of changes results in at most one render finishing after it. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None
+        self.token = None
+        self.busy = False
+
+    def submit(self, settings):
+        '''Stores a copy of the settings as the next render. Returns True
+        if the render thread is idle and has to be told to start.'''
+        with self.lock:
+            self.pending = dict(settings)
+            if self.token is not None:
+                self.token.cancel()
+            if self.busy:
+                return False
+            self.busy = True
+            return True
+
+    def next(self):
+        '''Called from the render thread. Returns the newest settings and a
+        token for cancelling the render, or None and None when there is
+        nothing left to render.'''
+        with self.lock:
+            settings, self.pending = self.pending, None
+            if settings is None:
+                self.busy = False
+                self.token = None
+            else:
+                self.token = CancellationToken()
+            return settings, self.token
+
+
+def image_address(image):
+    '''Returns the address of the pixel data of a QImage without detaching
+    it. Shallow copies of an image share the same address, and null images
+    have the address 0.'''
+    pointer = image.constBits()
+    return 0 if pointer is None else int(pointer)
+
+
+class ImageBufferPool:
+    """ Hands out ARGB32 images for the render thread to paint into. Every
+    image has a count of holders: the model holds the image it is painting
+    and the last finished image, and the GUI holds each image it is sent
+    until it calls release(). An image is only handed out again when nobody
+    holds it, so the render thread never paints into an image the GUI is
+    reading, and Qt never has to copy an image because it is shared.
+    Free images are reused as long as the canvas size stays the same.
+    A shared pool puts the pixels of its images in shared memory, so
+    worker processes can paint into them. """
+
+    def __init__(self, shared=False):
+        self.lock = threading.Lock()
+        self.images = list()
+        self.holders = dict()
+        self.shared = shared
+        self.memory = dict()
+        # Images that are not the pool's own, with what to do when they
+        # are no longer held
+        self.adopted = dict()
+        self.unheld = list()
+        if shared:
+            atexit.register(self.close)
+
+    def acquire(self, size_x, size_y):
+        '''Returns a free size_x by size_y image, held once by the caller'''
+        with self.lock:
+            # An image that is still shared with a copy somewhere would be
+            # detached, and so moved, by painting into it
+            free = [image for image in self.images
+                    if self.holders[image_address(image)] == 0 and image.isDetached()]
+            for image in free:
+                if image.width() == size_x and image.height() == size_y:
+                    self.holders[image_address(image)] = 1
+                    return image
+            # Free images of another size will not be needed again
+            for image in free:
+                self.images.remove(image)
+                del self.holders[image_address(image)]
+                self.free_memory(image_address(image))
+            if self.shared:
+                image = self.shared_image(size_x, size_y)
+            else:
+                image = qtg.QImage(size_x, size_y, qtg.QImage.Format_ARGB32)
+            self.images.append(image)
+            self.holders[image_address(image)] = 1
+            return image
+
+    def hold(self, image):
+        '''Adds a hold on an image. Like release, it ignores images that did
+        not come from the pool.'''
+        with self.lock:
+            address = image_address(image)
+            if address in self.holders:
+                self.holders[address] += 1
+
+    def release(self, image):
+        '''Gives up one hold on an image. Images that did not come from the
+        pool are ignored, so the GUI can release every image it is sent.'''
+        with self.lock:
+            address = image_address(image)
+            if self.holders.get(address, 0) > 0:
+                self.holders[address] -= 1
+                if self.holders[address] == 0 and address in self.adopted:
+                    del self.holders[address]
+                    self.unheld.append((address, self.adopted.pop(address)))
+
+    def adopt(self, image, on_free):
+        '''Counts holds on an image that did not come from the pool, such as
+        an image pointing into a memory map. It is never handed out by
+        acquire, and free_unheld calls on_free once nobody holds it.'''
+        with self.lock:
+            address = image_address(image)
+            if address not in self.holders:
+                self.holders[address] = 0
+                self.adopted[address] = on_free
+
+    def free_unheld(self):
+        '''Calls on_free for the adopted images nobody holds any more. This
+        is called from the render thread, which is the thread adopting
+        images, so an image is never freed while it is being adopted again.'''
+        with self.lock:
+            unheld = [on_free for address, on_free in self.unheld
+                      if address not in self.holders]
+            self.unheld.clear()
+        for on_free in unheld:
+            on_free()
+
+    def shared_image(self, size_x, size_y):
+        '''Returns an image painting straight into a new shared memory block'''
+        memory = shared_memory.SharedMemory(create=True, size=size_x*size_y*4)
+        pixels = np.ndarray((size_y, size_x), dtype=np.uint32, buffer=memory.buf)
+        image = qtg.QImage(sip.voidptr(pixels.ctypes.data), size_x, size_y,
+                           size_x*4, qtg.QImage.Format_ARGB32)
+        # The image does not own its pixels, so the memory is kept open
+        # for as long as the image is in the pool
+        self.memory[image_address(image)] = memory
+        del pixels
+        return image
+
+    def shared_name(self, image):
+        '''Returns the name worker processes open the pixels of an image by'''
+        return self.memory[image_address(image)].name
+
+    def free_memory(self, address):
+        memory = self.memory.pop(address, None)
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+    def close(self):
+        '''Frees the shared memory of every image in the pool'''
+        with self.lock:
+            for address in list(self.memory):
+                self.free_memory(address)
+            self.images.clear()
+            self.holders.clear()
+            self.adopted.clear()
+            self.unheld.clear()
+
 
 # RainbowModel includes all the code necessary to generate
 # each artwork
@@ -32,6 +221,12 @@ class RainbowModel(qtc.QObject):
     # Signals
     rendering = qtc.pyqtSignal(qtg.QImage)
     finished = qtc.pyqtSignal(qtg.QImage)
+    # Used internally to wake up the render thread
+    render_requested = qtc.pyqtSignal()
+    # Sent with the path of a canvas once it has been written
+    canvas_finished = qtc.pyqtSignal(str)
+    # Sent with the path and the error when a canvas could not be written
+    canvas_failed = qtc.pyqtSignal(str, str)
 
     # Instantiation method with defaults
     def __init__(self, parent, settings):
@@ -39,171 +234,304 @@ class RainbowModel(qtc.QObject):
         # Set basic parameters and create a blank canvas with the current settings
         self.first_render = True
         self.old_settings = settings
-        self.current_image = qtg.QImage(
-            settings['size_x'],
-            settings['size_y'],
-            qtg.QImage.Format_ARGB32)
+        # current_image is the front buffer, which holds the last finished
+        # image. New images are painted into a back buffer from the pool.
+        # Large images are split between worker processes when there is more
+        # than one core, and then the workers paint straight into the buffers
+        self.bands = BandRenderer()
+        self.buffers = ImageBufferPool(shared=self.bands.workers > 1)
+        self.current_image = self.buffers.acquire(settings['size_x'], settings['size_y'])
         self.current_image.fill(qtg.QColor('Gray'))
 
+        # Lightness and color bits only change the palette, so the stages
+        # leading up to the index image are skipped when only they change
+        # The image is painted column by column, starting with the columns
+        # in view, rather than by the rasterization stage
+        self.pipeline = rainbow_pipeline(rasterization=False)
+        # The x positions in view, set by the GUI
+        self.visible_x = (0, settings['size_x'])
+        self.progress_interval = 0.1
+        # The coarsest preview of a large image has at most this many pixels
+        self.preview_pixels = 65536
+        self.image_versions = None
+
+        # Finished renders, so settings that have been rendered before
+        # are shown again without rendering
+        self.cache = RenderCache(on_evict=self.buffers.release)
+        # Renders are also kept on disk, so they are still there the next
+        # time the program starts
+        self.disk_cache = DiskRenderCache(os.path.join(
+            qtc.QStandardPaths.writableLocation(qtc.QStandardPaths.GenericCacheLocation),
+            'NAITA Software', 'ComputerRainbow', 'renders'))
+        # A finished image is only written to disk once its settings have
+        # stayed put for store_delay seconds, so scrubbing a slider does
+        # not write every step
+        self.unstored = None
+        self.finished_at = 0
+        self.store_delay = 1.0
+
+        self.scheduler = RenderScheduler()
+        self.render_requested.connect(self.render_latest)
+
+    # set_viewport is called directly from the GUI thread whenever the view
+    # is scrolled or resized, so the next render knows what is in view
+    @qtc.pyqtSlot(qtc.QRect)
+    def set_viewport(self, rect):
+        self.visible_x = (rect.left(), rect.left() + rect.width())
+
+    # request_render is called directly from the GUI thread, and
+    # render_latest runs the newest request in the render thread
+    @qtc.pyqtSlot(dict)
+    def request_render(self, settings):
+        if self.scheduler.submit(settings):
+            self.render_requested.emit()
+
+    @qtc.pyqtSlot()
+    def render_latest(self):
+        settings, token = self.scheduler.next()
+        while settings is not None:
+            self.render(settings, token)
+            settings, token = self.scheduler.next()
+
     # render should be called in its own thread
     # it will send two signals:
-    # "rendering" with the previous image and the "rendering" overlay
+    # "rendering" with coarse previews and partly painted images of large
+    # images, small images are not sent until they are finished
     # "finished" with the finished image
+    # A render that is cancelled through token stops without emitting "finished"
     @qtc.pyqtSlot(dict)
-    def render(self, settings):
+    def render(self, settings, token=None):
         size_x = settings["size_x"]
         size_y = settings["size_y"]
-
-        rendering_image = self.current_image.convertToFormat(
-                                    qtg.QImage.Format_Grayscale8
-                                    )
-        painter = qtg.QPainter(rendering_image)
-        painter.setFont(qtg.QFont("Helvetica", pointSize = 32))
-        painter.drawText(25, 
-                        int(size_y/2 - 20),
-                        size_x,
-                        size_y,
-                        0,
-                        "RENDERING")
-        self.rendering.emit(rendering_image)
-        
-        center_wavelength = settings["cent_lambda"]
-        color_bits_start = settings["color_bits_start"]
-        color_res_x = settings["color_res_x"]
-        color_res_y = settings["color_res_y"]
-        color_no_start = settings["color_no_start"]
-        color_step_factor = settings["color_step_factor"]
-        light = settings["lightness"]
-
-        if size_x % color_res_x == 0:
-            color_steps = size_x // color_res_x - 1
-        else:
-            color_steps = size_x // color_res_x
-        no_of_colors_max = color_no_start + color_step_factor*color_steps
-        no_colors_max_displayed = ceil(size_y/color_res_y)
-        half_color_span = no_colors_max_displayed // 2
-
-        # Fill a list of lists with the wavelenghts for each section
-        # of the display
-        color_grid = list()
-        no_colors = color_no_start
-
-        while no_colors <= no_of_colors_max:
-            #print("Number of colors sought: ", no_colors)
-            color_column, center_i = self.wavelengths(int(no_colors), center_wavelength)
-            #print("Number of colors calculated: ", len(color_column))
-            start_i = 0
-            end_i = int(no_colors)
-            if no_colors > no_colors_max_displayed:
-                start_i = center_i - half_color_span
-                if start_i < 0:
-                    start_i = 0
-                end_i = start_i + no_colors_max_displayed
-                if end_i > no_colors:
-                    end_i = int(no_colors) + 1
-                    start_i = end_i - no_colors_max_displayed
-            no_colors = no_colors + color_step_factor
-
-            color_grid.append(color_column[start_i:end_i])
-            #print("Displaying ", end_i - start_i, " colors. From ", start_i, ' to ', end_i)
-            #print(*color_column, sep=', ')
-
-        # Convert the list of lists from wavelenghts to rgb-values
-        for col in range(len(color_grid)):
-            for row in range(len(color_grid[col])):
-                color_grid[col][row] = self.wavelength_to_RGB(color_grid[col][row], light, color_bits_start)
-
-        if not (size_x == self.current_image.size().width() &
-            size_y == self.current_image.size().height()):
-            self.current_image = qtg.QImage(size_x, size_y, qtg.QImage.Format_ARGB32)
-        self.current_image.fill(qtg.QColor('White'))
-        painter = qtg.QPainter(self.current_image)
-
-        # Variables for detemining when and where to draw color loss labels
-        label_y_pos = 0
-        color_loss_limit = 90 # First label at 90% unique
-        label_list = list()
-
-        x = 0
-        x_step = color_res_x
-        for col in color_grid:
-            y = 0
-            rows = len(col)
-            # print(rows)
-            mod_first_step = False
-            #print(rows, " colors")
-
-            # If the number of colors is insufficient to fill the height of the 
-            # column with the standard block height, we need to adjust the standard
-            # block height upwards. Use floor and ceil and pick the height that gives
-            # the closest fit to the actual size_y.
-            if color_res_y * rows < size_y:
-                y_step_max = int(ceil(size_y/rows))
-                y_step_min = int(floor(size_y/rows))
-                if abs(y_step_max*rows - size_y) <= abs(y_step_min*rows - size_y):
-                    y_step = y_step_max
-                else:
-                    y_step = y_step_min
-            else:
-                y_step = color_res_y
-
-
-            # If the corrent number of rows with the adjusted block height does not
-            # go nicely into the image height we need to adjust the heights of some of the blocks.
-            # We can't do all the adjustments at the ends, because the adjustment
-            # totals up to several blocks as the block heights get more numerous.
-            total_adjustment = 0
-            if size_y != y_step*rows:
-                total_adjustment = abs(y_step*rows - size_y)
-                # print('total adjustment', total_adjustment)
-                adjustment = (size_y - y_step*rows)/total_adjustment
-                freq = rows / total_adjustment
-                current_freq = freq
+        # The settings dialog allows a size of 0, which leaves nothing to
+        # render. The GUI is sent a null image, as it always was.
+        if size_x <= 0 or size_y <= 0:
+            self.finished.emit(qtg.QImage())
+            return
+
+        # Memory maps of images from the disk cache are closed once the
+        # memory cache and the GUI are done with them
+        self.buffers.free_unheld()
+        key = settings_key(settings)
+        cached_image = self.cache.get(key)
+        if cached_image is None:
+            cached_image = self.disk_cache.load(key)
+            if cached_image is not None:
+                self.buffers.adopt(cached_image, partial(self.disk_cache.close, key))
+                self.cache_image(key, cached_image)
+        if cached_image is not None:
+            self.show_cached(cached_image)
+            return
+
+        # Large images are first shown as coarse previews, each finer than
+        # the one before, and the last preview is painted over while the
+        # image itself is painted
+        preview = None
+        factors = preview_factors(settings, self.preview_pixels)
+        # A new lightness or color depth only changes the palette, and the
+        # image is repainted from the cached columns faster than the
+        # previews would be made
+        if not self.pipeline.stale_stages(settings) - {'quantization', 'labels'}:
+            factors = []
+        for factor in factors:
+            try:
+                preview = self.render_preview(settings, factor, token)
+            except RenderCancelled:
+                return
+            self.rendering.emit(preview)
+
+        if self.bands.enabled(settings):
+            back_image = self.buffers.acquire(size_x, size_y)
+            try:
+                label_list, dot_color = self.render_bands(back_image, settings, token, preview)
+            except RenderCancelled:
+                self.buffers.release(back_image)
+                return
+            except BrokenProcessPool:
+                # The workers could not be started, so this image and the
+                # ones after it are rendered here instead
+                print("Band workers died, rendering in one process")
+                self.buffers.release(back_image)
             else:
-                freq = rows + 2
-                adjustment = 0
-            
-            current_freq = freq
-            adjustments_completed = 0
-
-            # RGB color list to examine color uniqueness
-            rgb_list = list()
-
-            for row, cell in enumerate(col):
-                # if the row number for this row, counting from 1 is 0 modulo
-                # freq, adjust it to make the total height match the image height
-                #print('drawing row ', row, 'of ', rows)  
-                painter.setPen(
-                    cell)
-                painter.setBrush(
-                    cell)                
-                x_end = min(x + x_step - 1, size_x)
-                y_end = min(y + y_step - 1, size_y)
-                if row > current_freq:
-                    y_end = y_end + adjustment
-                    adjustments_completed = adjustments_completed + adjustment
-                    current_freq = current_freq + freq
-                   # print('adjusting row height by', adjustment)
-
-                painter.drawRect(x, y, x_end, y_end)
-
-                rgb_list.append(cell.rgb())
-
-                y = y_end + 1
-            # We want a label informing of resolution loss when 10% or more 
-            # of the boxes in one column have the same RGB code
-            rgb_set = set(rgb_list)
-            percent_unique = round(len(rgb_set)*100/len(rgb_list))
-            if percent_unique < color_loss_limit + 1:
-                print("Register percent unique ", percent_unique, "pct at x =", x)
-                label_list.append(x)
-                color_loss_limit = color_loss_limit - 10
-
-            x = x_end + 1
-            #print(f'Drew column with:{rows} color blox {y_step} high. Required adjustment {total_adjustment}. Completed adjustment {adjustments_completed}.')
+                # current_image no longer matches the stages
+                self.image_versions = None
+                self.finish_image(key, settings, back_image, label_list, dot_color)
+                return
+
+        try:
+            results = self.pipeline.run(settings, token)
+        except RenderCancelled:
+            return
+        # The image only needs to be painted again if one of the stages
+        # it is made from has changed
+        image_versions = tuple(self.pipeline.versions[stage] for stage in self.pipeline.stages)
+        if image_versions != self.image_versions:
+            back_image = self.buffers.acquire(size_x, size_y)
+            try:
+                self.paint_viewport_first(back_image, settings, results, token, preview)
+            except RenderCancelled:
+                self.buffers.release(back_image)
+                return
+            self.image_versions = image_versions
+            used_samples, block_index, rows = results['rgb']
+            dot_color = results['quantization'][block_index[-1]]
+            self.finish_image(key, settings, back_image, results['labels'], dot_color)
+            return
+
+        # The GUI holds the image until it calls release_image
+        self.buffers.hold(self.current_image)
+        self.finished.emit(self.current_image)
 
+    def render_preview(self, settings, factor, token=None):
+        '''Renders an image about factor times smaller than the image for
+        settings. The view scales it up to the size in its "shown_size" text.'''
+        preview_pixels, label_list, dot_color = render(
+            preview_settings(settings, factor), token, labels=False)
+        preview = qtg.QImage(preview_pixels.shape[1], preview_pixels.shape[0],
+                             qtg.QImage.Format_ARGB32)
+        image_pixels(preview)[:, :] = preview_pixels
+        preview.setText('shown_size', '{}x{}'.format(settings["size_x"], settings["size_y"]))
+        return preview
+
+    def paint_viewport_first(self, image, settings, results, token=None, preview=None):
+        '''Paints the columns in the viewport first and sends them to the GUI
+        straight away. The other columns are painted in the order the user is
+        likely to scroll to them, and the image is sent again every
+        progress_interval seconds while they are. Until then they show the
+        preview. Without a preview the unpainted columns would show whatever
+        was left in the buffer, so the image is only sent when finished.'''
+        pixels = image_pixels(image)
+        x_edges, y_edges = results['geometry']
+        left, right = self.visible_x
+        order, no_visible = column_order(x_edges, left, right)
+        if preview is None or no_visible == len(order):
+            paint_columns(pixels, settings, results, order, token)
+            return
+        self.paint_preview(image, preview)
+        paint_columns(pixels, settings, results, order[:no_visible], token)
+        # The GUI gets copies, as the image is still being painted. Copying
+        # large images takes a while, so they are sent less often.
+        start = monotonic()
+        self.rendering.emit(image.copy())
+        sent = monotonic()
+        interval = max(self.progress_interval, 4*(sent - start))
+        for first in range(no_visible, len(order), 64):
+            paint_columns(pixels, settings, results, order[first:first + 64], token)
+            if monotonic() - sent > interval and first + 64 < len(order):
+                self.rendering.emit(image.copy())
+                sent = monotonic()
+
+    def paint_preview(self, image, preview):
+        '''Scales a preview up to fill an image that is about to be painted'''
+        painter = qtg.QPainter(image)
+        painter.drawImage(image.rect(), preview)
+        painter.end()
+
+    def render_bands(self, image, settings, token=None, preview=None):
+        '''Renders an image in the band workers, which are handed the bands in
+        the viewport first. As in paint_viewport_first, the image is sent to
+        the GUI once the bands in view are painted and then every
+        progress_interval seconds, over the preview, but only when there is
+        a preview. Returns the labels and dot color of the image.'''
+        progress = None
+        if preview is not None:
+            self.paint_preview(image, preview)
+            sent = None
+            interval = self.progress_interval
+
+            def progress(visible_left, left):
+                nonlocal sent, interval
+                if visible_left or not left:
+                    return
+                if sent is None or monotonic() - sent > interval:
+                    start = monotonic()
+                    # The workers are still painting the other bands, so
+                    # the GUI gets a copy
+                    self.rendering.emit(image.copy())
+                    sent = monotonic()
+                    interval = max(self.progress_interval, 4*(sent - start))
+        return self.bands.render(settings, self.buffers.shared_name(image), token,
+                                 self.visible_x, progress)
+
+    def finish_image(self, key, settings, back_image, label_list, dot_color):
+        '''Adds the labels to a newly painted back buffer, makes it the front
+        buffer, stores it in the caches and sends it to the GUI'''
+        self.draw_labels(back_image, label_list, dot_color, settings["color_res_x"])
+        self.buffers.release(self.current_image)
+        self.current_image = back_image
+        self.cache_image(key, back_image)
+
+        # The GUI holds the image until it calls release_image
+        self.buffers.hold(self.current_image)
+        self.finished.emit(self.current_image)
+        self.unstored = (key, settings)
+        self.finished_at = monotonic()
+        qtc.QTimer.singleShot(int(self.store_delay*1000), self.store_current)
+
+    @qtc.pyqtSlot()
+    def store_current(self):
+        '''Writes the current image to the disk cache, unless another image
+        has been finished since or newer settings are waiting to be rendered.
+        The GUI only reads the image, and the read only view does not
+        detach it.'''
+        if (self.unstored is None or self.scheduler.pending is not None
+                or monotonic() - self.finished_at < 0.9*self.store_delay):
+            return
+        key, settings = self.unstored
+        self.unstored = None
+        self.disk_cache.store(key, image_pixels(self.current_image, writable=False), settings)
+
+    # render_to_canvas renders to a raw file in the render thread, painting
+    # straight into the file through a memory map, so canvases can be
+    # larger than memory
+    @qtc.pyqtSlot(str, dict, bool)
+    def render_to_canvas(self, path, settings, indexed):
+        # An exception escaping a slot would end the program
+        try:
+            render_canvas(path, settings, indexed)
+        except (OSError, ValueError) as error:
+            self.canvas_failed.emit(path, str(error))
+            return
+        self.canvas_finished.emit(path)
+
+    def cache_image(self, key, image):
+        '''Stores an image in the memory cache. The cache holds buffers from
+        the pool until they are evicted, so they are not copied and are not
+        painted into while they are cached.'''
+        if self.cache.put(key, image):
+            self.buffers.hold(image)
+
+    def show_cached(self, image):
+        '''Makes a cached image the current image and sends it to the GUI'''
+        self.buffers.release(self.current_image)
+        self.current_image = image
+        self.unstored = None
+        self.buffers.hold(image)
+        # current_image no longer matches the stages, so the next render
+        # that is not in the cache has to paint a new image
+        self.image_versions = None
+        # The GUI holds the image until it calls release_image
+        self.buffers.hold(image)
+        self.finished.emit(image)
+
+    def cache_stats(self):
+        '''Returns the hit rate and memory use of the render and column caches'''
+        stats = self.cache.stats()
+        stats['columns'] = column_cache.stats()
+        return stats
+
+    def release_image(self, image):
+        '''Called by the GUI when it no longer needs an image it was sent'''
+        self.buffers.release(image)
+
+    def draw_labels(self, image, label_list, dot_color, color_res_x):
+        '''Paints the color loss labels onto image'''
+        label_y_pos = 0
+        painter = qtg.QPainter(image)
+        # The label dots are filled with the color of the last block, which
+        # was the brush left behind when the blocks were drawn with the painter
+        painter.setBrush(qtg.QColor(int(dot_color)))
         if label_list:
-            print("Drawing percent unique", percent_unique)
             painter.setPen(qtg.QColor('White'))
             painter.setFont(qtg.QFont('Times', weight=12))
             percent_unique = 90
@@ -214,90 +542,15 @@ class RainbowModel(qtc.QObject):
                 painter.drawEllipse(x_pos + color_res_x // 2, label_y_pos + 4, 3, 3)
                 label_y_pos = label_y_pos + 25
                 percent_unique = percent_unique - 10
+        painter.end()
 
-
-        self.finished.emit(self.current_image)
+    def stage_stats(self):
+        '''Returns the cache hits and misses of each render stage'''
+        return self.pipeline.stats()
 
     def wavelengths(self, no_of_colors, center_wavelength):
-        delta_l = 360/no_of_colors
-        mid_specter = 560
-        wavelength_list = list()
-        start = 1
-        offset = 0
-        if no_of_colors % 2 == 0:
-            wavelength_list.append(mid_specter - delta_l*0.5)
-            wavelength_list.append(mid_specter + delta_l*0.5)
-            offset = 0.5
-        else:
-            wavelength_list.append(mid_specter)
-        
-        iterations = (no_of_colors - int(offset*4))//2
-        for i in range(1, iterations+1):
-            wavelength_list.append(mid_specter - delta_l*(i + offset))
-            wavelength_list.append(mid_specter + delta_l*(i + offset))
-
-        wavelength_list.sort()
-
-        i_center_wavelength = no_of_colors//2
-        deviation = abs(center_wavelength - wavelength_list[i_center_wavelength])
-
-        for i, wavelength in enumerate(wavelength_list):
-            this_deviation = abs(center_wavelength - wavelength)
-            if this_deviation < deviation:
-                i_center_wavelength = i
-                deviation = this_deviation
-        return wavelength_list, i_center_wavelength
+        return wavelengths(no_of_colors, center_wavelength)
 
     def wavelength_to_RGB(self, wavelength, light, bits):
-        '''Based on code found at http://www.noah.org/wiki/Wavelength_to_RGB_in_Python,
-        which again is based on FORTRAN code by Dan Bruton
-        http://www.physics.sfasu.edu/astro/color/spectra.html '''
-        wavelength = float(wavelength)
-        gamma = 0.7999
-        if wavelength >= 380 and wavelength <= 440:
-            attenuation = 0.2999 + 0.6999 * (wavelength - 380) / (440 - 380)
-            R = ((-(wavelength - 440) / (440 - 380)) * attenuation) ** gamma
-            G = 0.0
-            B = (1.0 * attenuation) ** gamma
-        elif wavelength >= 440 and wavelength <= 490:
-            R = 0.0
-            G = ((wavelength - 440) / (490 - 440)) ** gamma
-            B = 1.0
-        elif wavelength >= 490 and wavelength <= 510:
-            R = 0.0
-            G = 1.0
-            B = (-(wavelength - 510) / (510 - 490)) ** gamma
-        elif wavelength >= 510 and wavelength <= 580:
-            R = ((wavelength - 510) / (580 - 510)) ** gamma
-            G = 1.0
-            B = 0.0
-        elif wavelength >= 580 and wavelength <= 645:
-            R = 1.0
-            G = (-(wavelength - 645) / (645 - 580)) ** gamma
-            B = 0.0
-        elif wavelength >= 645 and wavelength <= 750:
-            attenuation = 0.3 + 0.7 * (750 - wavelength) / (750 - 645)
-            R = (1.0 * attenuation) ** gamma
-            G = 0.0
-            B = 0.0
-        else:
-            R = 0.0
-            G = 0.0
-            B = 0.0
-        if bits == 24:
-            R *= 255
-            G *= 255
-            B *= 255
-        elif bits == 12:
-            R = int(15 * R)*17
-            G = int(15 * G)*17
-            B = int(15 * B)*17
-        elif bits == 6:
-            R = int(3 * R)*85
-            G = int(3 * G)*85
-            B = int(3 * B)*85
-        
-        color = qtg.QColor(int(R), int(G), int(B))
-        color = color.lighter(100 + light*1.8) 
-
-        return color
\ No newline at end of file
+        '''Returns the QColor for a wavelength, looked up in the spectral_lut'''
+        return qtg.QColor(int(spectral_lut.lookup(wavelength, light, bits)))
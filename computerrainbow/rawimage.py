@@ -0,0 +1,196 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# A simple uncompressed image file: a fixed header, the settings the
+# image was rendered with as JSON, the palette of indexed images, and the
+# pixel rows. The pixels start at a 64 byte boundary so they can be memory
+# mapped and used directly, which also lets images larger than memory be
+# rendered into and viewed a piece at a time.
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+MAGIC = b'CRBWRAW\0'
+VERSION = 2
+# Pixel formats. Indexed pixels are positions in a palette of ARGB32 colors.
+ARGB32 = 1
+INDEXED8 = 2
+INDEXED16 = 3
+
+# Magic, version, format, width, height, settings length, palette length
+# and the offset of the pixels
+HEADER = struct.Struct('<8sHHIIIII')
+ALIGNMENT = 64
+
+dtypes = {ARGB32: np.uint32, INDEXED8: np.uint8, INDEXED16: np.uint16}
+
+
+def indexed_format(palette):
+    '''Returns the smallest indexed format that can hold the palette'''
+    return INDEXED8 if len(palette) <= 256 else INDEXED16
+
+
+def raw_header(width, height, settings, pixel_format, palette):
+    '''Returns the bytes in front of the pixels of a raw image'''
+    settings_json = json.dumps(settings, sort_keys=True).encode('utf-8')
+    palette_bytes = b''
+    if pixel_format != ARGB32:
+        palette_bytes = np.ascontiguousarray(palette, dtype='<u4').tobytes()
+    start = HEADER.size + len(settings_json) + len(palette_bytes)
+    offset = -(-start // ALIGNMENT) * ALIGNMENT
+    header = HEADER.pack(MAGIC, VERSION, pixel_format, width, height,
+                         len(settings_json), len(palette_bytes)//4, offset)
+    return header + settings_json + palette_bytes + b'\0' * (offset - start)
+
+
+class RawImageError(Exception):
+    '''Raised when a file is not a complete raw image'''
+
+
+class RawWriter:
+    """ Writes a raw image one strip of rows at a time. The file is written
+    under a temporary name and only moved to path by close(), so a crash
+    never leaves a partial file at path. """
+
+    def __init__(self, path, width, height, settings, pixel_format=ARGB32, palette=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.rows = 0
+        self.file = open(path + '.part', 'wb')
+        self.file.write(raw_header(width, height, settings, pixel_format, palette))
+
+    def write_rows(self, pixels):
+        '''Appends a 2D array of pixel rows'''
+        if pixels.shape[1] != self.width or self.rows + len(pixels) > self.height:
+            raise ValueError('rows do not fit the image')
+        self.file.write(np.ascontiguousarray(pixels, dtype=dtypes[self.pixel_format]).tobytes())
+        self.rows += len(pixels)
+
+    def close(self):
+        '''Finishes the file and moves it into place'''
+        if self.rows != self.height:
+            self.abort()
+            raise ValueError(f'{self.rows} of {self.height} rows were written')
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+    def abort(self):
+        '''Closes and removes the unfinished file'''
+        self.file.close()
+        os.remove(self.path + '.part')
+
+
+def write_raw(path, pixels, settings, pixel_format=ARGB32, palette=None):
+    '''Writes a 2D array of pixels to path. The file is written under a
+    temporary name first, so a crash never leaves a partial file at path.'''
+    height, width = pixels.shape
+    writer = RawWriter(path, width, height, settings, pixel_format, palette)
+    writer.write_rows(pixels)
+    writer.close()
+
+
+class RawCanvas:
+    """ A raw image that is rendered into through a writable memory map, so
+    it never has to fit in memory. The file is created at full size under a
+    temporary name, and moved to path by close(). The canvas owns the map,
+    and pixels is an array viewing the part of it after the header. """
+
+    def __init__(self, path, width, height, settings, pixel_format=ARGB32, palette=None):
+        self.path = path
+        header = raw_header(width, height, settings, pixel_format, palette)
+        with open(path + '.part', 'w+b') as raw_file:
+            raw_file.write(header)
+            # Leaves the pixels as a hole the file system fills in as they
+            # are written
+            raw_file.truncate(len(header) + width*height*np.dtype(dtypes[pixel_format]).itemsize)
+            # The map keeps the file open after it is closed here. Maps
+            # must start at a page, so the whole file is mapped.
+            self.map = mmap.mmap(raw_file.fileno(), 0)
+        self.pixels = np.frombuffer(self.map, dtype=dtypes[pixel_format], count=width*height,
+                                    offset=len(header)).reshape(height, width)
+
+    def flush(self):
+        '''Writes the pixels painted so far back to the file, so they no longer
+        take up memory'''
+        self.map.flush()
+
+    def unmap(self):
+        # The map can only be closed once no array views it, so other
+        # views of pixels must be gone before the canvas is closed
+        self.pixels = None
+        self.map.close()
+
+    def close(self):
+        '''Writes out the pixels, unmaps them and moves the file into place'''
+        self.map.flush()
+        self.unmap()
+        os.replace(self.path + '.part', self.path)
+
+    def abort(self):
+        '''Unmaps and removes the unfinished file'''
+        self.unmap()
+        os.remove(self.path + '.part')
+
+
+def read_header(path):
+    '''Returns a dictionary with the format, width, height, settings,
+    palette and pixel offset of a raw image. The palette is None for ARGB32
+    images.'''
+    with open(path, 'rb') as raw_file:
+        data = raw_file.read(HEADER.size)
+        if len(data) < HEADER.size:
+            raise RawImageError(f'{path} is too short for a raw image')
+        magic, version, pixel_format, width, height, settings_length, palette_length, offset = \
+            HEADER.unpack(data)
+        if magic != MAGIC or version != VERSION or pixel_format not in dtypes:
+            raise RawImageError(f'{path} is not a raw image this version can read')
+        settings = json.loads(raw_file.read(settings_length).decode('utf-8'))
+        palette = None
+        if pixel_format != ARGB32:
+            palette_bytes = raw_file.read(palette_length*4)
+            if len(palette_bytes) != palette_length*4:
+                raise RawImageError(f'{path} is too short for its palette')
+            palette = np.frombuffer(palette_bytes, dtype='<u4').astype(np.uint32)
+    header = {'format': pixel_format, 'width': width, 'height': height,
+              'settings': settings, 'palette': palette, 'offset': offset}
+    expected_size = offset + width*height*np.dtype(dtypes[pixel_format]).itemsize
+    if os.path.getsize(path) != expected_size:
+        raise RawImageError(f'{path} should be {expected_size} bytes')
+    return header
+
+
+def open_raw(path):
+    '''Returns the header of a raw image and its pixels as a read-only
+    memory mapped array. Nothing is read from the pixel rows until used.'''
+    header = read_header(path)
+    pixels = np.memmap(path, dtype=dtypes[header['format']], mode='r',
+                       offset=header['offset'],
+                       shape=(header['height'], header['width']))
+    return header, pixels
+
+
+def argb_region(header, pixels, x, y, width, height):
+    '''Returns the ARGB32 pixels of a rectangle of a raw image opened with
+    open_raw. Only the rows of the rectangle are read from the file.'''
+    region = pixels[y:y + height, x:x + width]
+    if header['palette'] is None:
+        return np.array(region)
+    return header['palette'][region]
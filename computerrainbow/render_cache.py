@@ -0,0 +1,177 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+import os
+import time
+from collections import OrderedDict
+
+from PyQt5 import QtGui as qtg
+from PyQt5 import sip
+
+from .core import settings_key
+from .rawimage import ARGB32, RawImageError, open_raw, write_raw
+
+
+# RenderCache keeps finished renders in memory
+class RenderCache:
+    """ A least recently used cache of finished images, keyed by settings_key.
+    The size of the cache is limited by the number of bytes the images take
+    up rather than the number of images, since a 2000x2000 image alone is
+    16 MB. Images larger than the whole budget are not stored. on_evict is
+    called with every image that is dropped from the cache. """
+
+    def __init__(self, max_bytes=256*1024*1024, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Returns the image stored under key, or None'''
+        image = self.images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.images.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        '''Stores an image and returns True, or False if it is too large.
+        The cache keeps the image as it is, so the caller must not paint into
+        it afterwards.'''
+        size = image.sizeInBytes()
+        if size > self.max_bytes:
+            return False
+        if key in self.images:
+            self.evict(key)
+        self.images[key] = image
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self.evict(next(iter(self.images)))
+        return True
+
+    def evict(self, key):
+        old_image = self.images.pop(key)
+        self.bytes -= old_image.sizeInBytes()
+        if self.on_evict is not None:
+            self.on_evict(old_image)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        '''Returns a dictionary with the numbers useful for tuning the cache'''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate(),
+                'images': len(self.images),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes}
+
+
+# DiskRenderCache keeps finished renders between sessions
+class DiskRenderCache:
+    """ Stores finished images as raw image files named after their
+    settings_key. Loaded files are memory mapped and wrapped in a QImage
+    without decoding or copying, so the pixels are only read from disk as
+    they are used. Files are removed when they are older than max_age
+    seconds, and the least recently used files are removed when the total
+    size goes above max_bytes. Images larger than max_bytes//8 are not
+    stored, so a single image never pushes out the rest of the cache. """
+
+    def __init__(self, directory, max_bytes=1024*1024*1024, max_age=30*24*60*60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_bytes//8
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        # The QImages point into the memory maps, so a map that has been
+        # handed out is kept open until close is called for it
+        self.maps = dict()
+        # The total size of the files, found by the first prune
+        self.bytes = None
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.raw')
+
+    def load(self, key):
+        '''Returns the image stored under key, or None'''
+        pixels = self.maps.get(key)
+        if pixels is None:
+            try:
+                header, pixels = open_raw(self.path(key))
+            except (OSError, ValueError, RawImageError):
+                return None
+            if header['format'] != ARGB32 or settings_key(header['settings']) != key:
+                return None
+            self.maps[key] = pixels
+        # Loading counts as a use when pruning
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        height, width = pixels.shape
+        return qtg.QImage(sip.voidptr(pixels.ctypes.data), width, height,
+                          pixels.strides[0], qtg.QImage.Format_ARGB32)
+
+    def close(self, key):
+        '''Closes the memory map of a loaded image. Images returned by load
+        for key must not be used afterwards.'''
+        self.maps.pop(key, None)
+
+    def store(self, key, pixels, settings):
+        '''Writes an array of ARGB pixels to the cache, and prunes it if it
+        has grown too large'''
+        if pixels.nbytes > self.max_file_bytes:
+            return
+        path = self.path(key)
+        if key in self.maps or os.path.exists(path):
+            return
+        if self.bytes is None:
+            self.prune()
+        try:
+            write_raw(path, pixels, settings)
+            self.bytes += os.path.getsize(path)
+        except OSError:
+            return
+        if self.bytes > self.max_bytes:
+            self.prune()
+
+    def prune(self):
+        '''Removes files that are too old, then the least recently used
+        files until the cache fits in max_bytes'''
+        now = time.time()
+        files = list()
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.raw'):
+                status = entry.stat()
+                files.append((status.st_mtime, status.st_size, entry.path))
+        files.sort()
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.bytes = total
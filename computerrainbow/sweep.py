@@ -0,0 +1,216 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# Renders every combination of a set of settings values in a pool of worker
+# processes, for making many variants of an artwork at once. Each output is
+# recorded in a manifest, one JSON object per line, once it is complete. A
+# sweep that is stopped part way picks up where it left off when run again.
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+
+from .core import DEFAULT_SETTINGS, compose, rainbow_pipeline, settings_key
+from .pngimage import write_png
+from .rawimage import RawImageError, read_header, write_raw
+
+MANIFEST_NAME = 'manifest.jsonl'
+# Settings that only change the palette. They vary fastest in the job grid,
+# so a worker going through its jobs in order mostly reuses its pipeline.
+PALETTE_KEYS = ('lightness', 'color_bits_start')
+
+
+def parse_values(text):
+    '''Turns a command line value into a list of integers. Accepts a single
+    value, a comma separated list, or a range given as start:stop or
+    start:stop:step, where stop is included.'''
+    if ':' in text:
+        parts = [int(part) for part in text.split(':')]
+        if len(parts) not in (2, 3) or (len(parts) == 3 and parts[2] == 0):
+            raise ValueError(f'{text} is not a range')
+        start, stop = parts[:2]
+        step = parts[2] if len(parts) == 3 else (1 if stop >= start else -1)
+        return list(range(start, stop + (1 if step > 0 else -1), step))
+    return [int(part) for part in text.split(',')]
+
+
+def expand_grid(base_settings, sweeps):
+    '''Returns the settings of every job, one for each combination of the
+    values in sweeps, which maps settings keys to lists of values. Settings
+    not in sweeps are taken from base_settings. A value given twice, as in
+    "--lightness 0,0", gives one job, since both would write the same file.'''
+    keys = [key for key in DEFAULT_SETTINGS if key in sweeps and key not in PALETTE_KEYS]
+    keys += [key for key in PALETTE_KEYS if key in sweeps]
+    jobs = dict()
+    for values in itertools.product(*(sweeps[key] for key in keys)):
+        settings = dict(base_settings)
+        settings.update(zip(keys, values))
+        jobs.setdefault(settings_key(settings), settings)
+    return list(jobs.values())
+
+
+def output_name(settings, file_format):
+    '''Names outputs after their settings, so the same settings always give
+    the same file'''
+    return f'rainbow-{settings_key(settings)[:16]}.{file_format}'
+
+
+# Each worker keeps one pipeline for all its jobs, so the wavelength grid,
+# spectral lookup tables and columns are only worked out once per worker
+worker_pipeline = None
+
+
+def render_jobs(jobs, directory, file_format):
+    '''Renders a list of jobs and writes them to directory. Runs in a worker
+    process. Returns a manifest record for every job.'''
+    global worker_pipeline
+    if worker_pipeline is None:
+        # Files have no labels, so they are not worked out
+        worker_pipeline = rainbow_pipeline(labels=False)
+    records = list()
+    for settings in jobs:
+        start = time.perf_counter()
+        results = worker_pipeline.run(settings)
+        pixels = np.empty((settings["size_y"], settings["size_x"]), dtype=np.uint32)
+        compose(pixels, results)
+        name = output_name(settings, file_format)
+        if file_format == 'raw':
+            write_raw(os.path.join(directory, name), pixels, settings)
+        else:
+            write_png(os.path.join(directory, name), pixels)
+        records.append({'key': settings_key(settings), 'path': name,
+                        'settings': settings,
+                        'bytes': os.path.getsize(os.path.join(directory, name)),
+                        'seconds': round(time.perf_counter() - start, 4)})
+    return records
+
+
+def read_manifest(directory):
+    '''Returns the records in the manifest of directory by settings key. A
+    last line cut short by a crash is removed from the file, so records
+    appended later start on a line of their own.'''
+    path = os.path.join(directory, MANIFEST_NAME)
+    records = dict()
+    if not os.path.exists(path):
+        return records
+    with open(path, 'rb+') as manifest:
+        data = manifest.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            manifest.truncate(complete)
+    for line in data[:complete].decode('utf-8').splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        records[record['key']] = record
+    return records
+
+
+def verify_output(directory, record):
+    '''Returns True if the file of a manifest record is still there and
+    complete'''
+    path = os.path.join(directory, record['path'])
+    try:
+        if os.path.getsize(path) != record['bytes']:
+            return False
+        if path.endswith('.raw'):
+            # Checks the header and that the file holds every row
+            read_header(path)
+        else:
+            with open(path, 'rb') as png_file:
+                png_file.seek(-12, os.SEEK_END)
+                if png_file.read()[4:8] != b'IEND':
+                    return False
+    except (OSError, KeyError, RawImageError):
+        return False
+    return True
+
+
+def remaining_jobs(jobs, directory, file_format):
+    '''Returns the jobs that do not have a complete output in directory from
+    an earlier run, and removes files left unfinished by a crash'''
+    for name in os.listdir(directory):
+        if name.endswith('.part'):
+            os.remove(os.path.join(directory, name))
+    records = read_manifest(directory)
+    remaining = list()
+    for settings in jobs:
+        record = records.get(settings_key(settings))
+        if (record is None or record['path'] != output_name(settings, file_format)
+                or not verify_output(directory, record)):
+            remaining.append(settings)
+    return remaining
+
+
+def run_sweep(jobs, directory, file_format='png', workers=None, chunk_size=None,
+              progress=None, resume=True):
+    '''Renders all jobs into directory using a pool of worker processes and
+    appends a record for each output to the manifest in directory. Jobs
+    with a complete output from an earlier run are skipped, unless resume
+    is False. Jobs are handed out in chunks of neighbouring jobs, which
+    share most of their intermediate results. progress is called with the
+    number of jobs done and the total. Returns the manifest records of the
+    jobs rendered.'''
+    os.makedirs(directory, exist_ok=True)
+    if resume:
+        total = len(jobs)
+        jobs = remaining_jobs(jobs, directory, file_format)
+        skipped = total - len(jobs)
+    else:
+        if os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+            os.remove(os.path.join(directory, MANIFEST_NAME))
+        skipped = 0
+    workers = workers or os.cpu_count() or 1
+    if chunk_size is None:
+        # Enough chunks to keep every worker busy to the end. Jobs are only
+        # recorded once their chunk is done, so chunks are kept small enough
+        # that little is lost when a run is stopped.
+        chunk_size = max(1, min(16, len(jobs) // (workers*4)))
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+
+    records = list()
+    with open(os.path.join(directory, MANIFEST_NAME), 'a') as manifest:
+        def record(chunk_records):
+            for chunk_record in chunk_records:
+                manifest.write(json.dumps(chunk_record, sort_keys=True) + '\n')
+            # A record is only on disk once the render it lists is
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            records.extend(chunk_records)
+            if progress is not None:
+                progress(skipped + len(records), skipped + len(jobs))
+
+        if workers == 1:
+            # The pipeline is kept between calls, so jobs can be recorded
+            # one at a time
+            for settings in jobs:
+                record(render_jobs([settings], directory, file_format))
+            return records
+
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) \
+                as executor:
+            pending = {executor.submit(render_jobs, chunk, directory, file_format)
+                       for chunk in chunks}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(future.result())
+    return records
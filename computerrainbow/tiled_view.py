@@ -0,0 +1,195 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+# Basic QT classes
+from PyQt5 import QtWidgets as qtw 
+from PyQt5 import QtGui as qtg 
+from PyQt5 import QtCore as qtc
+from PyQt5 import sip
+from collections import OrderedDict
+
+from .rawimage import argb_region
+
+TILE_SIZE = 256
+
+
+class ImageTiles:
+    """ Tiles cut from a QImage as they are needed. A preview that stands for
+    a larger image has the size it is shown at in its "shown_size" text, as
+    WIDTHxHEIGHT, and its tiles are scaled up one at a time. """
+
+    def __init__(self, image):
+        self.image = image
+        shown_size = image.text('shown_size')
+        if shown_size:
+            width, height = shown_size.split('x')
+            self.shown_size = qtc.QSize(int(width), int(height))
+        else:
+            self.shown_size = image.size()
+
+    def size(self):
+        return self.shown_size
+
+    def tile(self, rect):
+        if self.shown_size == self.image.size():
+            return self.image.copy(rect)
+        tile = qtg.QImage(rect.size(), qtg.QImage.Format_ARGB32)
+        painter = qtg.QPainter(tile)
+        # Only the part of the scaled image that falls on the tile is drawn
+        painter.drawImage(qtc.QRect(-rect.x(), -rect.y(),
+                                    self.shown_size.width(), self.shown_size.height()),
+                          self.image)
+        painter.end()
+        return tile
+
+
+class CanvasTiles:
+    """ Tiles read from a memory mapped raw canvas as they are needed, so
+    only the parts of the file that are looked at are read """
+
+    def __init__(self, header, pixels):
+        self.header = header
+        self.pixels = pixels
+
+    def size(self):
+        return qtc.QSize(self.header['width'], self.header['height'])
+
+    def tile(self, rect):
+        pixels = argb_region(self.header, self.pixels,
+                             rect.x(), rect.y(), rect.width(), rect.height())
+        image = qtg.QImage(sip.voidptr(pixels.ctypes.data), rect.width(), rect.height(),
+                           pixels.strides[0], qtg.QImage.Format_ARGB32)
+        # The image does not own pixels, which go away with this function
+        return image.copy()
+
+
+class TiledView(qtw.QAbstractScrollArea):
+    """ Shows an image of any size in a scroll area. The image is split into
+    tiles of TILE_SIZE pixels, and a tile is only turned into a pixmap when
+    it is first scrolled into view. Tiles that have not been shown for a
+    while are dropped when the pixmaps take up more than max_bytes. """
+    # Sent with the part of the image in view whenever it changes
+    viewport_changed = qtc.pyqtSignal(qtc.QRect)
+
+    def __init__(self, parent=None, max_bytes=64*1024*1024):
+        super().__init__(parent)
+        self.max_bytes = max_bytes
+        self.source = None
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.busy_text = None
+
+    def set_image(self, image):
+        '''Shows a QImage, scaled up if it is a preview. The view keeps the
+        image and reads tiles from it while it is shown, so it must not be
+        painted into meanwhile.'''
+        self.set_source(ImageTiles(image))
+
+    def set_canvas(self, header, pixels):
+        '''Shows a raw canvas opened with open_raw'''
+        self.set_source(CanvasTiles(header, pixels))
+
+    def set_source(self, source):
+        self.source = source
+        self.tiles.clear()
+        self.bytes = 0
+        self.update_scroll_bars()
+        self.viewport().update()
+        self.viewport_changed.emit(self.visible_rect())
+
+    def set_busy(self, text):
+        '''Shows text over the image until set_busy is called with None.
+        It is painted over the viewport, so the image is left as it is.'''
+        self.busy_text = text
+        self.viewport().update()
+
+    def image_size(self):
+        if self.source is None:
+            return qtc.QSize(0, 0)
+        return self.source.size()
+
+    def sizeHint(self):
+        return self.image_size() + qtc.QSize(2*self.frameWidth(), 2*self.frameWidth())
+
+    def update_scroll_bars(self):
+        size = self.image_size()
+        viewport = self.viewport().size()
+        for bar, length, page in ((self.horizontalScrollBar(), size.width(), viewport.width()),
+                                  (self.verticalScrollBar(), size.height(), viewport.height())):
+            bar.setRange(0, max(0, length - page))
+            bar.setPageStep(page)
+            bar.setSingleStep(20)
+
+    def resizeEvent(self, event):
+        self.update_scroll_bars()
+        super().resizeEvent(event)
+        self.viewport_changed.emit(self.visible_rect())
+
+    def scrollContentsBy(self, dx, dy):
+        self.viewport().update()
+        self.viewport_changed.emit(self.visible_rect())
+
+    def visible_rect(self):
+        '''Returns the part of the image in the viewport, in image coordinates'''
+        return qtc.QRect(self.horizontalScrollBar().value(), self.verticalScrollBar().value(),
+                         self.viewport().width(), self.viewport().height())
+
+    def tile(self, column, row):
+        '''Returns the pixmap of a tile, converting it if it is not cached'''
+        key = column, row
+        pixmap = self.tiles.get(key)
+        if pixmap is None:
+            rect = qtc.QRect(column*TILE_SIZE, row*TILE_SIZE, TILE_SIZE, TILE_SIZE)
+            rect = rect.intersected(qtc.QRect(qtc.QPoint(0, 0), self.image_size()))
+            pixmap = qtg.QPixmap.fromImage(self.source.tile(rect))
+            self.tiles[key] = pixmap
+            self.bytes += pixmap.width()*pixmap.height()*4
+        else:
+            self.tiles.move_to_end(key)
+        return pixmap
+
+    def evict(self):
+        '''Drops the tiles shown longest ago until the cache is within budget'''
+        while self.bytes > self.max_bytes and len(self.tiles) > 1:
+            key, pixmap = self.tiles.popitem(last=False)
+            self.bytes -= pixmap.width()*pixmap.height()*4
+
+    def paintEvent(self, event):
+        painter = qtg.QPainter(self.viewport())
+        painter.fillRect(event.rect(), self.palette().window())
+        if self.source is not None:
+            visible = self.visible_rect()
+            painted = visible.intersected(qtc.QRect(qtc.QPoint(0, 0), self.image_size()))
+            if not painted.isEmpty():
+                # Only the tiles that overlap the viewport are converted and drawn
+                for row in range(painted.top() // TILE_SIZE, painted.bottom() // TILE_SIZE + 1):
+                    for column in range(painted.left() // TILE_SIZE,
+                                        painted.right() // TILE_SIZE + 1):
+                        painter.drawPixmap(column*TILE_SIZE - visible.x(),
+                                           row*TILE_SIZE - visible.y(),
+                                           self.tile(column, row))
+                self.evict()
+        if self.busy_text is not None:
+            # A translucent band behind the text keeps it readable without
+            # hiding the previews shown while rendering
+            painter.setFont(qtg.QFont("Helvetica", pointSize = 32))
+            band = painter.fontMetrics().height() + 20
+            top = self.viewport().height()//2 - band//2
+            painter.fillRect(0, top, self.viewport().width(), band, qtg.QColor(128, 128, 128, 160))
+            painter.drawText(25, top, self.viewport().width(), band,
+                             qtc.Qt.AlignVCenter, self.busy_text)
+        painter.end()
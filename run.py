@@ -17,4 +17,6 @@
 
 from computerrainbow.__main__ import main
 
-main()
\ No newline at end of file
+# Worker processes import this script without running it
+if __name__ == '__main__':
+    main()
\ No newline at end of file
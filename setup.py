@@ -15,21 +15,23 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
 
-    from setuptools import setup
-    setup{
-        name='ComputerRainbow',
-        version='0.9',
-        author='Bjoernar Tuftin',
-        author_email='btuftin@gmail.com',
-        description='a program for experimenting with rgb rainbows',
-        url="https://github.com/btuftin/computer-rainbow",
-        license='GPL v3',
-        long_description=open('README.rst', 'r').read(),
-        packages=['computerrainbow', 'computerrainbow.images'],
-        install_requires=['PyQt5'],
-        entry_points={
-            'console_scripts': [
-                'computerrainbow = computerrainbow.__main__:main'
-            ]
-        }
-    }
\ No newline at end of file
+
+from setuptools import setup
+
+setup(
+    name='ComputerRainbow',
+    version='0.9',
+    author='Bjoernar Tuftin',
+    author_email='btuftin@gmail.com',
+    description='a program for experimenting with rgb rainbows',
+    url="https://github.com/btuftin/computer-rainbow",
+    license='GPL v3',
+    long_description=open('README.rst', 'r').read(),
+    packages=['computerrainbow', 'computerrainbow.images'],
+    install_requires=['PyQt5', 'numpy'],
+    entry_points={
+        'console_scripts': [
+            'computerrainbow = computerrainbow.__main__:main'
+        ]
+    }
+)
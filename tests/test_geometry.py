@@ -0,0 +1,48 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+import random
+
+import numpy as np
+
+from computerrainbow.core import block_geometry, block_rectangles
+
+
+def coverage(rows, size_x, size_y, color_res_x):
+    '''Returns how many blocks cover each pixel of the canvas'''
+    x_edges, y_edges = block_geometry(rows, size_x, size_y, color_res_x)
+    count = np.zeros((size_y, size_x), dtype=np.int64)
+    for left, top, right, bottom in zip(*block_rectangles(x_edges, y_edges, rows)):
+        count[top:bottom, left:right] += 1
+    return count
+
+
+def test_every_pixel_painted_once():
+    generator = random.Random(5)
+    for layout in range(300):
+        size_x = generator.randint(1, 300)
+        size_y = generator.randint(1, 300)
+        color_res_x = generator.randint(1, 40)
+        no_columns = -(-size_x // color_res_x)
+        rows = [generator.randint(1, 2*size_y) for column in range(no_columns)]
+        assert (coverage(rows, size_x, size_y, color_res_x) == 1).all(), \
+            (size_x, size_y, color_res_x, rows)
+
+
+def test_blocks_not_dividing_the_canvas():
+    # 7 pixels wide columns on 100 pixels and 3 blocks on 100 rows
+    assert (coverage([3]*15, 100, 100, 7) == 1).all()
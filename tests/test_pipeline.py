@@ -0,0 +1,114 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+import random
+
+import numpy as np
+
+from computerrainbow.core import (CancellationToken, RenderCancelled, compose, paint_columns,
+                                  rainbow_pipeline, render)
+from test_render import random_settings
+
+
+class CountdownToken(CancellationToken):
+    """ A token that cancels itself after a given number of checks """
+
+    def __init__(self, checks):
+        super().__init__()
+        self.checks = checks
+
+    def check(self):
+        self.checks -= 1
+        if self.checks < 0:
+            self.cancel()
+        super().check()
+
+
+def changed(generator, settings):
+    '''Returns the settings with one to three of them changed, as when the
+    user moves a slider or resizes the window'''
+    new = dict(settings)
+    other = random_settings(generator)
+    for key in generator.sample(sorted(other), generator.randint(1, 3)):
+        if key in ('size_x', 'size_y', 'cent_lambda', 'color_no_start'):
+            # Small steps, so the incremental stages have something to reuse
+            new[key] = max(1, new[key] + generator.randint(-20, 20))
+        else:
+            new[key] = other[key]
+    return new
+
+
+def run_composed(pipeline, settings, token):
+    results = pipeline.run(settings, token)
+    pixels = np.empty((settings["size_y"], settings["size_x"]), dtype=np.uint32)
+    label_list, dot_color = compose(pixels, results)
+    return pixels, label_list
+
+
+def run_painted(pipeline, settings, token):
+    results = pipeline.run(settings, token)
+    pixels = np.empty((settings["size_y"], settings["size_x"]), dtype=np.uint32)
+    columns = np.arange(len(results['geometry'][0]) - 1)
+    # Paint in a shuffled order, as the viewport may put any column first
+    np.random.default_rng(len(columns)).shuffle(columns)
+    paint_columns(pixels, settings, results, columns, token)
+    return pixels, results['labels']
+
+
+def check_sequence(run, seed, steps=40):
+    '''Runs a random sequence of settings through one pipeline, cancelling
+    some of the renders part way, and checks every finished render against
+    a fresh render of the same settings'''
+    generator = random.Random(seed)
+    pipeline = rainbow_pipeline(rasterization=run is run_composed)
+    settings = random_settings(generator)
+    for step in range(steps):
+        settings = changed(generator, settings)
+        if generator.random() < 0.3:
+            try:
+                run(pipeline, settings, CountdownToken(generator.randint(0, 20)))
+            except RenderCancelled:
+                pass
+            # Often the cancelled settings are the ones rendered next
+            if generator.random() < 0.5:
+                settings = changed(generator, settings)
+        pixels, label_list = run(pipeline, settings, CancellationToken())
+        expected_pixels, expected_labels, dot_color = render(settings)
+        assert np.array_equal(pixels, expected_pixels), (seed, step, settings)
+        assert label_list == expected_labels, (seed, step, settings)
+
+
+def test_composed_sequences_match_fresh_renders():
+    for seed in range(4):
+        check_sequence(run_composed, seed)
+
+
+def test_painted_sequences_match_fresh_renders():
+    for seed in range(4):
+        check_sequence(run_painted, seed)
+
+
+def test_stale_stages_of_a_palette_change():
+    settings = random_settings(random.Random(24))
+    pipeline = rainbow_pipeline()
+    assert pipeline.stale_stages(settings) == set(pipeline.stages)
+    pipeline.run(settings)
+    assert pipeline.stale_stages(settings) == set()
+    assert pipeline.stale_stages(dict(settings, lightness=settings["lightness"] + 1)) == \
+        {'quantization', 'labels'}
+    assert pipeline.stale_stages(dict(settings, size_y=settings["size_y"] + 1)) == \
+        set(pipeline.stages)
@@ -0,0 +1,77 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+import random
+
+import numpy as np
+
+from computerrainbow.core import (block_geometry, block_rectangles, column_window, render,
+                                  render_strips, spectral_lut)
+
+
+def random_settings(generator):
+    return {'size_x': generator.randint(1, 400),
+            'size_y': generator.randint(1, 300),
+            'lightness': generator.randint(-50, 50),
+            'cent_lambda': generator.randint(380, 750),
+            'color_bits_start': generator.choice([6, 12, 24]),
+            'color_res_x': generator.randint(1, 40),
+            'color_res_y': generator.randint(1, 40),
+            'color_no_start': generator.randint(3, 256),
+            'color_step_factor': generator.randint(1, 16)}
+
+
+def reference_render(settings):
+    '''Paints the blocks one at a time, the way the program once drew a
+    rectangle for every block'''
+    size_x = settings["size_x"]
+    size_y = settings["size_y"]
+    no_colors_max_displayed = -(-size_y // settings["color_res_y"])
+    no_columns = -(-size_x // settings["color_res_x"])
+    colors = list()
+    rows = list()
+    for i in range(no_columns):
+        no_colors = settings["color_no_start"] + settings["color_step_factor"]*i
+        window = column_window(no_colors, settings["cent_lambda"], no_colors_max_displayed)
+        colors.extend(spectral_lut.lookup(window, settings["lightness"],
+                                          settings["color_bits_start"]))
+        rows.append(len(window))
+    x_edges, y_edges = block_geometry(rows, size_x, size_y, settings["color_res_x"])
+    pixels = np.zeros((size_y, size_x), dtype=np.uint32)
+    for color, left, top, right, bottom in zip(colors, *block_rectangles(x_edges, y_edges, rows)):
+        pixels[top:bottom, left:right] = color
+    return pixels
+
+
+def test_render_matches_block_by_block_painting():
+    generator = random.Random(4)
+    for run in range(60):
+        settings = random_settings(generator)
+        pixels, label_list, dot_color = render(settings)
+        assert np.array_equal(pixels, reference_render(settings)), settings
+
+
+def test_strips_match_render():
+    generator = random.Random(20)
+    for run in range(40):
+        settings = random_settings(generator)
+        if run % 2:
+            # Columns with many more colors than fit in them
+            settings['color_no_start'] = generator.randint(1000, 100000)
+        strip_height = generator.choice([None, 1, 7])
+        strips = [pixels for y, pixels in render_strips(settings, strip_height)]
+        assert np.array_equal(np.concatenate(strips), render(settings)[0]), settings
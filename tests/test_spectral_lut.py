@@ -0,0 +1,45 @@
+'''ComputerRainbow - a toy program rendering rainbows at different resolutions
+    Copyright (C) 2020  Bjoernar Tuftin
+
+    This file is part of ComputerRainbow, a small PyQt based program.
+    The program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.'''
+
+import numpy as np
+
+from computerrainbow.core import SpectralLUT, spectral_lut, wavelengths_to_ARGB
+
+
+def channel_error(a, b):
+    return max(int(np.abs((a >> shift & 0xff).astype(np.int64) - (b >> shift & 0xff)).max())
+               for shift in (16, 8, 0))
+
+
+def test_lookup_within_max_error():
+    generator = np.random.default_rng(2)
+    # Wavelengths on both sides of the edges of the spectrum are included
+    samples = np.concatenate([generator.uniform(370, 760, 20000),
+                              380 + generator.uniform(-1, 1, 2000)/64,
+                              750 + generator.uniform(-1, 1, 2000)/64])
+    for light, bits in ((0, 24), (0, 12), (-30, 6), (40, 24)):
+        error = channel_error(spectral_lut.lookup(samples, light, bits),
+                              wavelengths_to_ARGB(samples, light, bits))
+        assert error <= spectral_lut.max_error(light, bits), (light, bits)
+
+
+def test_outside_the_spectrum_is_black():
+    lut = SpectralLUT()
+    outside = np.array([380 - 1/256, 380 - 1/128, 750 + 1/256, 750 + 1/128, 200, 900])
+    assert (lut.index(outside) == lut.size).all()
+    assert (lut.lookup(outside, 0, 24) == wavelengths_to_ARGB(outside, 0, 24)).all()
+    assert (lut.index([380, 750]) == [0, lut.size - 1]).all()